@@ -120,6 +120,20 @@ else:
         }    
     }
 
+# Cache, local memory cache is used by default, in production it can be
+# switched to a shared backend like memcached or redis
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {
+            # entries are evicted when this number is reached
+            'MAX_ENTRIES': 10000,
+        }
+    }
+}
+
 # Customized auth backend, glue OAuth2 and Django User model together
 # https://docs.djangoproject.com/en/3.0/topics/auth/customizing/#authentication-backends
 
@@ -209,6 +223,69 @@ DEFAULT_GAME_IMAGE = os.path.join(GAME_MEDIA_PATH_ROOT, 'default.svg')
 # Timeout of requests to Mastodon, in seconds
 MASTODON_TIMEOUT = 30
 
+# Max concurrent requests to Mastodon when resolving cross site ids in bulk
+MASTODON_CONCURRENT_REQUESTS = 8
+
+# How long relationships between Mastodon users are cached, in seconds
+MASTODON_RELATIONSHIP_CACHE_TIMEOUT = 300
+
+# Max kept-alive connections to each Mastodon site
+MASTODON_POOL_SIZE = 10
+
+# Retries on connection errors and 429/5xx responses, with exponential backoff in seconds
+MASTODON_MAX_RETRIES = 2
+MASTODON_RETRY_BACKOFF_FACTOR = 0.5
+
+# Requests to a Mastodon site are refused for MASTODON_CIRCUIT_BREAKER_TIMEOUT seconds
+# after MASTODON_CIRCUIT_BREAKER_THRESHOLD consecutive failures
+MASTODON_CIRCUIT_BREAKER_THRESHOLD = 5
+MASTODON_CIRCUIT_BREAKER_TIMEOUT = 30
+
+# Toots are published out of the request and retried MASTODON_TOOT_MAX_ATTEMPTS times,
+# waiting MASTODON_TOOT_RETRY_INTERVAL * 2^attempts seconds between attempts
+MASTODON_TOOT_MAX_ATTEMPTS = 5
+MASTODON_TOOT_RETRY_INTERVAL = 30
+
+# Scrape results are cached in memory by url for SCRAPE_CACHE_TIMEOUT seconds,
+# at most SCRAPE_CACHE_MAX_ENTRIES of them including cover images
+SCRAPE_CACHE_TIMEOUT = 3600
+SCRAPE_CACHE_MAX_ENTRIES = 200
+
+# Max kept-alive connections to each host scraped
+SCRAPE_POOL_SIZE = 10
+
+# Retries of scraping requests on connection errors and 429/5xx responses,
+# with exponential backoff in seconds
+SCRAPE_MAX_RETRIES = 2
+SCRAPE_RETRY_BACKOFF_FACTOR = 1
+
+# Max requests per second to each host scraped
+SCRAPE_DEFAULT_RATE_LIMIT = 5
+SCRAPE_RATE_LIMITS = {
+    'api.scraperapi.com': 5,
+    'api.spotify.com': 10,
+}
+
+# Max concurrent cover image downloads, which run in background while pages are parsed
+SCRAPE_IMAGE_WORKERS = 8
+
+# Number of threads running douban sync tasks. Each task runs for
+# SYNC_TIME_SLICE seconds before yielding to others, and is leased for
+# SYNC_LEASE_TIME seconds, after which other workers may take it over.
+# On shutdown, running tasks are given SYNC_DRAIN_TIMEOUT seconds to stop.
+SYNC_WORKERS = 2
+SYNC_TIME_SLICE = 60
+SYNC_LEASE_TIME = 300
+SYNC_DRAIN_TIMEOUT = 20
+
+# Progress of sync tasks is saved every SYNC_FLUSH_ROWS rows or SYNC_FLUSH_INTERVAL seconds
+SYNC_FLUSH_ROWS = 50
+SYNC_FLUSH_INTERVAL = 5
+
+# Max concurrent scrapings of a douban sync task, and of each host across all tasks
+SYNC_SCRAPE_WORKERS = 8
+SYNC_SCRAPE_CONCURRENCY_PER_HOST = 4
+
 # Tags for toots posted from this site
 MASTODON_TAGS = '#NiceDB #NiceDB%(category)s #NiceDB%(category)s%(type)s'
 
@@ -1,10 +1,11 @@
 import uuid
 import django.contrib.postgres.fields as postgres
+from django.contrib.postgres.indexes import GinIndex
 from django.utils.translation import ugettext_lazy as _
 from django.db import models
 from django.core.serializers.json import DjangoJSONEncoder
 from django.shortcuts import reverse
-from common.models import Entity, Mark, Review, Tag
+from common.models import Entity, Mark, Review, Tag, TagFrequency
 from common.utils import GenerateDateUUIDMediaFilePath
 from boofilsic.settings import BOOK_MEDIA_PATH_ROOT, DEFAULT_BOOK_IMAGE
 from django.utils import timezone
@@ -46,6 +47,8 @@ class Book(Entity):
     cover = models.ImageField(_("cover picture"), upload_to=book_cover_path, default=DEFAULT_BOOK_IMAGE, blank=True)
     contents = models.TextField(blank=True, default="")
 
+    search_fields = ['title', 'subtitle', 'orig_title']
+
     class Meta:
         # more info: https://docs.djangoproject.com/en/2.2/ref/models/options/
         # set managed=False if the model represents an existing table or
@@ -58,6 +61,12 @@ class Book(Entity):
             models.CheckConstraint(check=models.Q(pub_month__lte=12), name='pub_month_upperbound'),
             models.CheckConstraint(check=models.Q(pub_month__gte=1), name='pub_month_lowerbound'),
         ]
+        indexes = [
+            # requires postgres extension pg_trgm, and a UTF-8 LC_CTYPE
+            # database so that CJK characters are taken into trigrams
+            GinIndex(fields=['search_text'], name='book_search_trgm',
+                     opclasses=['gin_trgm_ops']),
+        ]
 
     def __str__(self):
         return self.title
@@ -68,6 +77,9 @@ class Book(Entity):
     def get_tags_manager(self):
         return self.book_tags
 
+    def get_tag_frequencies_manager(self):
+        return self.book_tag_frequencies
+
     @property
     def verbose_category_name(self):
         return _("书籍")
@@ -96,3 +108,15 @@ class BookTag(Tag):
         constraints = [
             models.UniqueConstraint(fields=['content', 'mark'], name="unique_bookmark_tag")
         ]
+
+
+class BookTagFrequency(TagFrequency):
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='book_tag_frequencies')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['book', 'content'], name="unique_book_tag_frequency")
+        ]
+        indexes = [
+            models.Index(fields=['book', '-frequency'], name='book_tag_frequency_idx'),
+        ]
@@ -5,15 +5,15 @@ from django.utils.translation import gettext_lazy as _
 from django.http import HttpResponseBadRequest, HttpResponseServerError
 from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
 from django.db import IntegrityError, transaction
-from django.db.models import Count
 from django.utils import timezone
 from django.core.paginator import Paginator
 from mastodon import mastodon_request_included
-from mastodon.api import check_visibility, post_toot, TootVisibilityEnum
+from mastodon.api import check_visibility, TootVisibilityEnum
+from mastodon.jobs import enqueue_toot
 from mastodon.utils import rating_to_emoji
 from common.utils import PageLinksGenerator
 from common.views import PAGE_LINK_NUMBER, jump_or_scrape
-from common.models import SourceSiteEnum
+from common.models import SourceSiteEnum, UserMarkStats
 from .models import *
 from .forms import *
 from .forms import BookMarkStatusTranslator
@@ -21,7 +21,6 @@ from boofilsic.settings import MASTODON_TAGS
 
 
 logger = logging.getLogger(__name__)
-mastodon_logger = logging.getLogger("django.mastodon")
 
 
 # how many marks showed on the detail page
@@ -148,8 +147,7 @@ def retrieve(request, id):
         review = None
 
         # retreive tags
-        book_tag_list = book.book_tags.values('content').annotate(
-            tag_frequency=Count('content')).order_by('-tag_frequency')[:TAG_NUMBER]
+        book_tag_list = book.get_tag_list(TAG_NUMBER)
 
         # retrieve user mark and initialize mark form
         try:
@@ -184,10 +182,11 @@ def retrieve(request, id):
             mark_list_more = None
             review_list_more = None
         else:
+            # fetch one more item to tell if there are more
             mark_list = BookMark.get_available(
-                book, request.user, request.session['oauth_token'])
+                book, request.user, request.session['oauth_token'], MARK_NUMBER + 1)
             review_list = BookReview.get_available(
-                book, request.user, request.session['oauth_token'])
+                book, request.user, request.session['oauth_token'], REVIEW_NUMBER + 1)
             mark_list_more = True if len(mark_list) > MARK_NUMBER else False
             mark_list = mark_list[:MARK_NUMBER]
             for m in mark_list:
@@ -242,7 +241,9 @@ def delete(request, id):
         if request.user.is_staff:
             # only staff has right to delete
             book = get_object_or_404(Book, pk=id)
-            book.delete()
+            with transaction.atomic():
+                UserMarkStats.remove_marks(book.book_marks.all())
+                book.delete()
             return redirect(reverse("common:home"))
         else:
             raise PermissionDenied()
@@ -263,11 +264,13 @@ def create_update_mark(request):
         pk = request.POST.get('id')
         old_rating = None
         old_tags = None
+        old_stats_key = None
         if pk:
             mark = get_object_or_404(BookMark, pk=pk)
             if request.user != mark.owner:
                 return HttpResponseBadRequest()
             old_rating = mark.rating
+            old_stats_key = mark.get_stats_key()
             old_tags = mark.bookmark_tags.all()
             # update
             form = BookMarkForm(request.POST, instance=mark)
@@ -288,6 +291,12 @@ def create_update_mark(request):
                     # update book rating
                     book.update_rating(old_rating, form.instance.rating)
                     form.save()
+                    UserMarkStats.update_stats(old_stats_key, form.instance.get_stats_key())
+                    # update tag frequencies before old tags are deleted
+                    book.update_tag_frequencies(
+                        [tag.content for tag in old_tags] if old_tags else None,
+                        form.cleaned_data['tags']
+                    )
                     # update tags
                     if old_tags:
                         for tag in old_tags:
@@ -318,11 +327,7 @@ def create_update_mark(request):
                 tags = ''
                 content = words + '\n' + url + '\n' + \
                     form.cleaned_data['text'] + '\n' + tags
-                response = post_toot(
-                    request.user.mastodon_site, content, visibility, request.session['oauth_token'])
-                if response.status_code != 200:
-                    mastodon_logger.error(f"CODE:{response.status_code} {response.text}")
-                    return HttpResponseServerError("publishing mastodon status failed")
+                enqueue_toot(request.user, content, visibility, request.session['oauth_token'])
         else:
             return HttpResponseBadRequest("invalid form data")
 
@@ -368,6 +373,9 @@ def delete_mark(request, id):
             with transaction.atomic():
                 # update book rating
                 mark.book.update_rating(mark.rating, None)
+                mark.book.update_tag_frequencies(
+                    [tag.content for tag in mark.bookmark_tags.all()], None)
+                UserMarkStats.update_stats(mark.get_stats_key(), None)
                 mark.delete()
         except IntegrityError as e:
             return HttpResponseServerError()
@@ -409,12 +417,7 @@ def create_review(request, book_id):
                 tags = ''
                 content = words + '\n' + url + \
                     '\n' + form.cleaned_data['title'] + '\n' + tags
-                response = post_toot(
-                    request.user.mastodon_site, content, visibility, request.session['oauth_token'])
-                if response.status_code != 200:
-                    mastodon_logger.error(
-                        f"CODE:{response.status_code} {response.text}")
-                    return HttpResponseServerError("publishing mastodon status failed")
+                enqueue_toot(request.user, content, visibility, request.session['oauth_token'])
             return redirect(reverse("books:retrieve_review", args=[form.instance.id]))
         else:
             return HttpResponseBadRequest()
@@ -461,11 +464,7 @@ def update_review(request, id):
                 tags = ''
                 content = words + '\n' + url + \
                     '\n' + form.cleaned_data['title'] + '\n' + tags
-                response = post_toot(
-                    request.user.mastodon_site, content, visibility, request.session['oauth_token'])
-                if response.status_code != 200:
-                    mastodon_logger.error(f"CODE:{response.status_code} {response.text}")
-                    return HttpResponseServerError("publishing mastodon status failed")
+                enqueue_toot(request.user, content, visibility, request.session['oauth_token'])
             return redirect(reverse("books:retrieve_review", args=[form.instance.id]))
         else:
             return HttpResponseBadRequest()
@@ -1,5 +1,47 @@
 from django.apps import AppConfig
+from django.core.management import call_command
+from django.db.models.signals import post_migrate
+
+
+def populate_mark_stats(sender, **kwargs):
+    """
+    Fill mark stats from existing marks once the table is created, so that
+    counts are right without reconciling by hand after upgrading.
+    """
+    from common.models import UserMarkStats
+    if not UserMarkStats.objects.exists():
+        UserMarkStats.rebuild()
+
+
+def populate_search_text(sender, **kwargs):
+    """
+    Fill search text of entities created before it was added, which are
+    not found by searching otherwise.
+    """
+    call_command('rebuild_search_index', missing_only=True, verbosity=kwargs.get('verbosity', 1))
+
+
+def populate_tag_frequencies(sender, **kwargs):
+    """
+    Fill tag frequencies from existing tags once their tables are created,
+    tags are not shown on entity pages otherwise.
+    """
+    call_command('rebuild_tag_frequencies', missing_only=True, verbosity=kwargs.get('verbosity', 1))
+
+
+def populate_markdown_contents(sender, **kwargs):
+    """
+    Render html and excerpts of contents saved before they were added,
+    which are shown blank otherwise.
+    """
+    call_command('render_markdown_contents', missing_only=True, verbosity=kwargs.get('verbosity', 1))
 
 
 class CommonConfig(AppConfig):
     name = 'common'
+
+    def ready(self):
+        post_migrate.connect(populate_mark_stats, sender=self)
+        post_migrate.connect(populate_search_text, sender=self)
+        post_migrate.connect(populate_tag_frequencies, sender=self)
+        post_migrate.connect(populate_markdown_contents, sender=self)
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from common.models import Entity
+from common.utils import bulk_update_in_batches
+
+
+def update_search_text(entity):
+    entity.search_text = entity.get_search_text()
+
+
+class Command(BaseCommand):
+    help = 'Rebuild `search_text` of all entities, requires postgres extension pg_trgm'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--missing-only', action='store_true',
+            help='only fill entities without search text, e.g. created before upgrading')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        for name, entity_class in Entity.get_category_mapping_dict().items():
+            queryset = entity_class.objects.order_by('pk')
+            if options['missing_only']:
+                queryset = queryset.filter(search_text='')
+            if name == 'song':
+                # song's search text contains its album title
+                queryset = queryset.select_related('album')
+            updated = bulk_update_in_batches(queryset, ['search_text'], update_search_text, batch_size)
+            if options['verbosity'] > 0:
+                self.stdout.write(f"{updated} {name} rebuilt")
@@ -0,0 +1,36 @@
+from django.db import transaction
+from django.db.models import Count
+from django.core.management.base import BaseCommand
+from common.models import Entity
+
+
+class Command(BaseCommand):
+    help = 'Rebuild denormalized tag frequencies of all entities from tags'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--missing-only', action='store_true',
+            help='only fill categories without any tag frequency yet, e.g. after upgrading')
+
+    def handle(self, *args, **options):
+        for name, entity_class in Entity.get_category_mapping_dict().items():
+            # relation names follow the convention `<entity>_tags`
+            tag_class = entity_class._meta.get_field(f'{name}_tags').related_model
+            frequency_class = entity_class._meta.get_field(
+                f'{name}_tag_frequencies').related_model
+            if options['missing_only'] and (
+                    frequency_class.objects.exists() or not tag_class.objects.exists()):
+                continue
+            rows = tag_class.objects.filter(**{f'{name}__isnull': False}).values(
+                name, 'content').annotate(frequency=Count('id')).order_by()
+            with transaction.atomic():
+                frequency_class.objects.all().delete()
+                frequency_class.objects.bulk_create((
+                    frequency_class(**{
+                        f'{name}_id': row[name],
+                        'content': row['content'],
+                        'frequency': row['frequency'],
+                    }) for row in rows.iterator()
+                ), batch_size=1000)
+            if options['verbosity'] > 0:
+                self.stdout.write(f"{name} tag frequencies rebuilt")
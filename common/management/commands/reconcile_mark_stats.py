@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from common.models import UserMarkStats
+
+
+class Command(BaseCommand):
+    help = 'Rebuild denormalized mark counts of all users from marks'
+
+    def handle(self, *args, **options):
+        rebuilt = UserMarkStats.rebuild()
+        self.stdout.write(f"{rebuilt} mark stats rebuilt")
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from common.models import Entity
+from common.utils import bulk_update_in_batches
+from management.models import Announcement
+
+
+class Command(BaseCommand):
+    help = 'Render `content_html` and `excerpt` of all reviews and announcements from markdown contents'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--missing-only', action='store_true',
+            help='only render contents not rendered yet, e.g. saved before upgrading')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        model_classes = [
+            # relation names follow the convention `<entity>_reviews`
+            entity_class._meta.get_field(f'{name}_reviews').related_model
+            for name, entity_class in Entity.get_category_mapping_dict().items()
+        ]
+        model_classes.append(Announcement)
+        for model_class in model_classes:
+            queryset = model_class.objects.order_by('pk')
+            if options['missing_only']:
+                queryset = queryset.filter(content_html='').exclude(content='')
+            updated = bulk_update_in_batches(
+                queryset,
+                ['content_html', 'excerpt'],
+                lambda instance: instance.render_content(),
+                batch_size,
+            )
+            if options['verbosity'] > 0:
+                self.stdout.write(f"{updated} {model_class.__name__} rendered")
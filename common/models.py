@@ -1,19 +1,74 @@
 import re
+import logging
 from decimal import *
 from markdown import markdown
 from django.utils.translation import ugettext_lazy as _
-from django.db import models, IntegrityError
+from django.db import models, IntegrityError, transaction
 from django.core.serializers.json import DjangoJSONEncoder
-from django.db.models import Q
+from django.db.models import Q, Count, F, Sum, Func, Value, OuterRef, Subquery, ExpressionWrapper
+from django.db.models.functions import Cast, Greatest
+from django.contrib.postgres.indexes import GinIndex
 from markdownx.models import MarkdownxField
 from users.models import User
-from mastodon.api import get_relationships, get_cross_site_id
+from mastodon.api import get_relationships, get_cross_site_ids
 from boofilsic.settings import CLIENT_NAME
 from django.utils import timezone
+from django.utils.text import Truncator
 
+logger = logging.getLogger(__name__)
 
 RE_HTML_TAG = re.compile(r"<[^>]*>")
 
+# how many user owned entities are checked at once by `get_available`
+AVAILABLE_CHUNK_SIZE = 40
+
+# max length of plain text excerpts of markdown contents
+EXCERPT_LENGTH = 200
+
+
+def apply_counter_deltas(model_class, key_fields, counter_field, deltas):
+    """
+    Add deltas to the counter field of denormalized counter rows in bulk,
+    with one UPDATE for each distinct delta, which are mostly 1 or -1.
+    Missing rows are created, and rows counted down to 0 are deleted.
+    Counters that would go below 0 have drifted from what they count, they
+    are logged and kept at 0, since drifts should never fail the writes they
+    follow, and are fixed by rebuilding.
+    @param key_fields: fields identifying a counter row
+    @param deltas: in form of {(values of key_fields): delta}
+    """
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    model_class.objects.bulk_create([
+        model_class(**dict(zip(key_fields, key)), **{counter_field: 0})
+        for key, delta in deltas.items() if delta > 0
+    ], ignore_conflicts=True)
+    keys_by_delta = {}
+    for key, delta in deltas.items():
+        keys_by_delta.setdefault(delta, []).append(key)
+    decreased = Q()
+    for delta, keys in keys_by_delta.items():
+        condition = Q()
+        for key in keys:
+            condition |= Q(**dict(zip(key_fields, key)))
+        if delta < 0:
+            drifted = model_class.objects.filter(condition, **{counter_field + '__lt': -delta})
+            drifted_keys = set(drifted.values_list(*key_fields))
+            updated = model_class.objects.filter(condition).update(
+                **{counter_field: Greatest(F(counter_field) + delta, 0)})
+            missing = len(keys) - updated
+            if drifted_keys or missing:
+                logger.warning(
+                    f"{model_class.__name__} drifted, {counter_field} of {drifted_keys} "
+                    f"below {-delta}, {missing} rows missing")
+            decreased |= condition
+        else:
+            model_class.objects.filter(condition).update(
+                **{counter_field: F(counter_field) + delta})
+    if decreased:
+        model_class.objects.filter(decreased, **{counter_field: 0}).delete()
+
 
 # abstract base classes
 ###################################
@@ -42,6 +97,11 @@ class Entity(models.Model):
     # source_url should include shceme, which is normally https://
     source_url = models.URLField(_("URL"), max_length=500, unique=True)
     source_site = models.CharField(_("源网站"), choices=SourceSiteEnum.choices, max_length=50)
+    # lower cased concatenation of `search_fields`, indexed by trigram
+    search_text = models.TextField(blank=True, default='', editable=False)
+
+    # fields that are searchable, subclasses should specify them
+    search_fields = []
 
     class Meta:
         abstract = True
@@ -51,6 +111,12 @@ class Entity(models.Model):
             models.CheckConstraint(check=models.Q(
                 rating__lte=10), name='%(class)s_rating_upperbound'),
         ]
+        indexes = [
+            # requires postgres extension pg_trgm, and a UTF-8 LC_CTYPE
+            # database so that CJK characters are taken into trigrams
+            GinIndex(fields=['search_text'], name='%(class)s_search_trgm',
+                     opclasses=['gin_trgm_ops']),
+        ]
 
 
     def get_absolute_url(self):
@@ -65,8 +131,23 @@ class Entity(models.Model):
             self.rating = None
         else:
             raise IntegrityError()
+        self.search_text = self.get_search_text()
         super().save(*args, **kwargs)
 
+    def get_search_text(self):
+        """
+        Concatenate values of `search_fields` into one lower cased string,
+        so that `search_text__contains` lookups can be served by the trigram index.
+        """
+        texts = []
+        for field in self.search_fields:
+            value = getattr(self, field)
+            if isinstance(value, (list, tuple)):
+                texts += [str(v) for v in value if v]
+            elif value:
+                texts.append(str(value))
+        return ' '.join(texts).lower()
+
     def calculate_rating(self, old_rating, new_rating):
         if (not (self.rating and self.rating_total_score and self.rating_number)
                 and (self.rating or self.rating_total_score or self.rating_number))\
@@ -115,6 +196,43 @@ class Entity(models.Model):
         """
         raise NotImplementedError("Subclass should implement this method.")
 
+    def get_tag_frequencies_manager(self):
+        """
+        Works like `get_tags_manager`, returns the manager of denormalized tag frequencies.
+        """
+        raise NotImplementedError("Subclass should implement this method.")
+
+    def get_tag_list(self, limit):
+        """
+        Return the most frequent tags of this entity, in the same format as
+        `values('content').annotate(tag_frequency=Count('content'))`.
+        """
+        return self.get_tag_frequencies_manager().order_by('-frequency', 'content').values(
+            'content', tag_frequency=F('frequency'))[:limit]
+
+    def update_tag_frequencies(self, old_tags, new_tags):
+        """
+        Should be called in the same transaction where the tags of a mark are changed.
+        @param old_tags: tag contents of the mark before change, None if mark is created
+        @param new_tags: tag contents of the mark after change, None if mark is deleted
+        """
+        old_tags = set(old_tags) if old_tags else set()
+        new_tags = set(new_tags) if new_tags else set()
+        manager = self.get_tag_frequencies_manager()
+        removed_tags = old_tags - new_tags
+        added_tags = new_tags - old_tags
+        if removed_tags:
+            manager.filter(content__in=removed_tags).update(frequency=F('frequency') - 1)
+            manager.filter(content__in=removed_tags, frequency=0).delete()
+        if added_tags:
+            frequency_class = manager.model
+            entity_field = self.__class__.__name__.lower()
+            frequency_class.objects.bulk_create([
+                frequency_class(content=tag, frequency=0, **{entity_field: self})
+                for tag in added_tags
+            ], ignore_conflicts=True)
+            manager.filter(content__in=added_tags).update(frequency=F('frequency') + 1)
+
     def get_marks_manager(self):
         """
         Normally this won't be used. 
@@ -144,6 +262,75 @@ class Entity(models.Model):
     def verbose_category_name(self):
         raise NotImplementedError("Subclass should implement this.")
 
+    @staticmethod
+    def set_tag_lists(entities, limit):
+        """
+        Attach the most frequent tags to each entity as `tag_list`,
+        using one query for each entity class instead of one query per entity.
+        @param entities: entities of one or multiple classes
+        @param limit: max number of tags attached to each entity
+        """
+        entities_by_class = {}
+        for entity in entities:
+            entity.tag_list = []
+            entities_by_class.setdefault(entity.__class__, []).append(entity)
+
+        for entity_class, class_entities in entities_by_class.items():
+            # the foreign key field that points to entity
+            # is named as the lower case name of that entity
+            entity_field = entity_class.__name__.lower()
+            frequency_class = class_entities[0].get_tag_frequencies_manager().model
+            entity_dict = {entity.pk: entity for entity in class_entities}
+            tag_frequencies = frequency_class.objects.filter(**{
+                entity_field + '__in': list(entity_dict)
+            }).values(entity_field, 'content', 'frequency').order_by(
+                entity_field, '-frequency', 'content')
+            for row in tag_frequencies:
+                tag_list = entity_dict[row[entity_field]].tag_list
+                if len(tag_list) < limit:
+                    tag_list.append({
+                        'content': row['content'],
+                        'tag_frequency': row['frequency'],
+                    })
+
+    @classmethod
+    def recalculate_ratings(cls, entity_ids):
+        """
+        Recalculate rating fields of given entities from their marks in one UPDATE,
+        used instead of `update_rating` when marks are written in bulk.
+        """
+        entity_field = cls.__name__.lower()
+        mark_class = cls._meta.get_field(entity_field + '_marks').related_model
+        # 0 is taken as no rating, same as `calculate_rating`
+        ratings = mark_class.objects.filter(
+            **{entity_field: OuterRef('pk')}, rating__gt=0
+        ).order_by().values(entity_field)
+        total_score = Subquery(ratings.annotate(total=Sum('rating')).values('total'))
+        number = Subquery(ratings.annotate(number=Count('pk')).values('number'))
+        decimal_field = models.DecimalField(max_digits=10, decimal_places=1)
+        cls.objects.filter(pk__in=entity_ids).update(
+            rating_total_score=total_score,
+            rating_number=number,
+            # null when there's no rating
+            rating=Func(
+                ExpressionWrapper(Cast(total_score, decimal_field) / number,
+                                  output_field=decimal_field),
+                Value(1),
+                function='ROUND',
+                output_field=decimal_field,
+            ),
+        )
+
+    @classmethod
+    def apply_tag_frequency_deltas(cls, deltas):
+        """
+        Bulk version of `update_tag_frequencies`.
+        @param deltas: in form of {(entity_id, tag_content): frequency_delta}
+        """
+        entity_field = cls.__name__.lower()
+        frequency_class = cls._meta.get_field(entity_field + '_tag_frequencies').related_model
+        apply_counter_deltas(frequency_class, [entity_field + '_id', 'content'], 'frequency', deltas)
+
 
 class UserOwnedEntity(models.Model):
     is_private = models.BooleanField()
@@ -156,18 +343,72 @@ class UserOwnedEntity(models.Model):
         abstract = True
 
     @classmethod
-    def get_available(cls, entity, request_user, token):
-        # TODO add amount limit for once query
+    def get_list_queryset(cls):
+        """
+        Queryset used when listing user owned entities,
+        subclasses may defer columns that are not shown in lists.
+        """
+        return cls.objects.all()
+
+    @classmethod
+    def get_entity_field_name(cls):
+        """
+        The foreign key field that points to entity,
+        which is named as the lower case name of that entity.
+        """
+        for field in cls._meta.get_fields():
+            if field.many_to_one and issubclass(field.related_model, Entity):
+                return field.name
+
+    @classmethod
+    def get_available(cls, entity, request_user, token, limit=None):
         """ 
-        Returns all avaliable user-owned entities related to given entity. 
+        Returns avaliable user-owned entities related to given entity. 
         This method handles mute/block relationships and private/public visibilities.
+
+        :param limit: stop once this many available entities are found, 
+            None means returning all of them
         """
+        available_entities = []
+        chunk_size = max(limit, AVAILABLE_CHUNK_SIZE) if limit else AVAILABLE_CHUNK_SIZE
+        for e in cls.iter_available(entity, request_user, token, chunk_size):
+            available_entities.append(e)
+            if limit is not None and len(available_entities) >= limit:
+                break
+        return available_entities
+
+    @classmethod
+    def iter_available(cls, entity, request_user, token, chunk_size=None):
+        """
+        Yields avaliable user-owned entities related to given entity, ordered by edited time.
+        User-owned entities are fetched and checked chunk by chunk, so that the caller 
+        only pays for the chunks it consumes.
+        """
+        if chunk_size is None:
+            chunk_size = AVAILABLE_CHUNK_SIZE
         # the foreign key field that points to entity
         # has to be named as the lower case name of that entity
-        query_kwargs = {entity.__class__.__name__.lower(): entity}
-        user_owned_entities = cls.objects.filter(
-            **query_kwargs).order_by("-edited_time")
+        entity_field = entity.__class__.__name__.lower()
+        user_owned_entities = cls.get_list_queryset().filter(
+            **{entity_field: entity}).select_related('owner').order_by("-edited_time", "-pk")
+
+        offset = 0
+        while True:
+            chunk = list(user_owned_entities[offset:offset + chunk_size])
+            for e in chunk:
+                # the entity is known, saves a query for each one
+                setattr(e, entity_field, entity)
+            if chunk:
+                yield from cls.filter_available(chunk, request_user, token)
+            if len(chunk) < chunk_size:
+                return
+            offset += chunk_size
 
+    @classmethod
+    def filter_available(cls, user_owned_entities, request_user, token):
+        """
+        Returns those of given user-owned entities that are available to request user.
+        """
         # every user should only be abled to have one user owned entity for each entity
         # this is guaranteed by models
         id_list = []
@@ -175,21 +416,20 @@ class UserOwnedEntity(models.Model):
         # none_index tracks those failed cross site id query
         none_index = []
 
+        # resolve all owners' ids at request user's site in bulk
+        cross_site_ids = get_cross_site_ids(
+            [entity.owner for entity in user_owned_entities], request_user.mastodon_site, token)
+
         for (i, entity) in enumerate(user_owned_entities):
-            if entity.owner.mastodon_site == request_user.mastodon_site:
-                id_list.append(entity.owner.mastodon_id)
+            cross_site_id = cross_site_ids.get(entity.owner.pk)
+            if not cross_site_id is None:
+                id_list.append(cross_site_id)
             else:
-                # TODO there could be many requests therefore make the pulling asynchronized
-                cross_site_id = get_cross_site_id(
-                    entity.owner, request_user.mastodon_site, token)
-                if not cross_site_id is None:
-                    id_list.append(cross_site_id)
-                else:
-                    none_index.append(i)
-                    # populate those query-failed None postions
-                    # to ensure the consistency of the orders of 
-                    # the three(id_list, user_owned_entities, relationships)
-                    id_list.append(request_user.mastodon_id)
+                none_index.append(i)
+                # populate those query-failed None postions
+                # to ensure the consistency of the orders of 
+                # the three(id_list, user_owned_entities, relationships)
+                id_list.append(request_user.mastodon_id)
 
         # Mastodon request
         relationships = get_relationships(
@@ -219,7 +459,8 @@ class UserOwnedEntity(models.Model):
         :param owner: visited user
         :param is_following: if the current user is following the owner
         """
-        user_owned_entities = cls.objects.filter(owner=owner)
+        user_owned_entities = cls.get_list_queryset().filter(
+            owner=owner).select_related(cls.get_entity_field_name())
         if not is_following:
             user_owned_entities = user_owned_entities.exclude(is_private=True)
         return user_owned_entities
@@ -253,21 +494,184 @@ class Mark(UserOwnedEntity):
     # TODO update entity rating when save
     # TODO update tags
 
+    @classmethod
+    def get_category_name(cls):
+        """
+        The lower case name of marked entity class, e.g. `book` for `BookMark`.
+        """
+        return cls.__name__[:-len('Mark')].lower()
 
-class Review(UserOwnedEntity):
-    title = models.CharField(max_length=120)
-    content = MarkdownxField()
+    def get_stats_key(self):
+        """
+        Key of the `UserMarkStats` row counting this mark.
+        """
+        return (self.owner_id, self.get_category_name(), self.status, self.is_private)
+
+
+class UserMarkStats(models.Model):
+    """
+    How many marks of a category and a status a user has.
+    Denormalized from marks, maintained by `update_stats` and `apply_deltas`.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='mark_stats')
+    category = models.CharField(max_length=20)
+    status = models.CharField(choices=MarkStatusEnum.choices, max_length=20)
+    is_private = models.BooleanField()
+    count = models.PositiveIntegerField(default=0)
 
     def __str__(self):
-        return self.title
+        return f"{self.user} {self.category} {self.status}({self.count})"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'category', 'status', 'is_private'], name='unique_user_mark_stats')
+        ]
+
+    @classmethod
+    def get_counts(cls, user, include_private):
+        """
+        Returns mark counts of the user in form of {(category, status): count}.
+        """
+        stats = cls.objects.filter(user=user)
+        if not include_private:
+            stats = stats.filter(is_private=False)
+        counts = {}
+        for category, status, count in stats.values_list('category', 'status', 'count'):
+            counts[(category, status)] = counts.get((category, status), 0) + count
+        return counts
+
+    @classmethod
+    def rebuild(cls):
+        """
+        Rebuild stats of all users from marks, returns the number of stats rows.
+        """
+        stats = []
+        for name, entity_class in Entity.get_category_mapping_dict().items():
+            # relation names follow the convention `<entity>_marks`
+            mark_class = entity_class._meta.get_field(f'{name}_marks').related_model
+            rows = mark_class.objects.values(
+                'owner', 'status', 'is_private').annotate(count=Count('id')).order_by()
+            stats += [
+                cls(
+                    user_id=row['owner'],
+                    category=mark_class.get_category_name(),
+                    status=row['status'],
+                    is_private=row['is_private'],
+                    count=row['count'],
+                ) for row in rows.iterator()
+            ]
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(stats, batch_size=1000)
+        return len(stats)
+
+    @classmethod
+    def reconcile(cls, user, mark_classes, status):
+        """
+        Recount stats of the user for marks of given classes and the status,
+        e.g. when they are found drifted from marks.
+        """
+        stats = []
+        for mark_class in mark_classes:
+            rows = mark_class.objects.filter(owner=user, status=status).values(
+                'is_private').annotate(count=Count('id')).order_by()
+            stats += [
+                cls(
+                    user=user,
+                    category=mark_class.get_category_name(),
+                    status=status,
+                    is_private=row['is_private'],
+                    count=row['count'],
+                ) for row in rows
+            ]
+        categories = [mark_class.get_category_name() for mark_class in mark_classes]
+        logger.warning(f"reconciling {status} {categories} mark stats of {user}")
+        with transaction.atomic():
+            cls.objects.filter(user=user, category__in=categories, status=status).delete()
+            cls.objects.bulk_create(stats)
+
+    @classmethod
+    def update_stats(cls, old_key, new_key):
+        """
+        Should be called in the same transaction where a mark is changed.
+        @param old_key: `Mark.get_stats_key()` before change, None if mark is created
+        @param new_key: `Mark.get_stats_key()` after change, None if mark is deleted
+        """
+        if old_key == new_key:
+            return
+        deltas = {}
+        if old_key is not None:
+            deltas[old_key] = -1
+        if new_key is not None:
+            deltas[new_key] = 1
+        cls.apply_deltas(deltas)
+
+    @classmethod
+    def remove_marks(cls, marks):
+        """
+        Should be called in the same transaction before marks are deleted in bulk,
+        for example when their entity is deleted.
+        @param marks: queryset of marks of one mark class
+        """
+        category = marks.model.get_category_name()
+        rows = marks.order_by().values('owner', 'status', 'is_private').annotate(count=Count('pk'))
+        cls.apply_deltas({
+            (row['owner'], category, row['status'], row['is_private']): -row['count']
+            for row in rows
+        })
+
+    @classmethod
+    def apply_deltas(cls, deltas):
+        """
+        Bulk version of `update_stats`.
+        @param deltas: in form of {(user_id, category, status, is_private): count_delta}
+        """
+        apply_counter_deltas(cls, ['user_id', 'category', 'status', 'is_private'], 'count', deltas)
+
+
+class MarkdownContent(models.Model):
+    """
+    Markdown content, rendered on save so that lists don't have to render markdown.
+    """
+    content = MarkdownxField()
+    content_html = models.TextField(blank=True, default='', editable=False)
+    excerpt = models.TextField(blank=True, default='', editable=False)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        self.render_content()
+        super().save(*args, **kwargs)
+
+    def render_content(self):
+        """
+        Render markdown content into `content_html` and the plain text `excerpt`.
+        """
+        self.content_html = markdown(self.content)
+        self.excerpt = Truncator(
+            RE_HTML_TAG.sub(' ', self.content_html)).chars(EXCERPT_LENGTH, truncate="...")
 
     def get_plain_content(self):
         """
         Get plain text format content
         """
-        html = markdown(self.content)
+        html = self.content_html or markdown(self.content)
         return RE_HTML_TAG.sub(' ', html)
 
+
+class Review(UserOwnedEntity, MarkdownContent):
+    title = models.CharField(max_length=120)
+
+    def __str__(self):
+        return self.title
+
+    @classmethod
+    def get_list_queryset(cls):
+        # lists only show excerpts
+        return cls.objects.defer('content', 'content_html')
+
     class Meta:
         abstract = True
 
@@ -280,3 +684,18 @@ class Tag(models.Model):
 
     class Meta:
         abstract = True
+
+
+class TagFrequency(models.Model):
+    """
+    How many marks of an entity are tagged with the content.
+    Denormalized from tags, maintained by `Entity.update_tag_frequencies`.
+    """
+    content = models.CharField(max_length=50)
+    frequency = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.content}({self.frequency})"
+
+    class Meta:
+        abstract = True
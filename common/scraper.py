@@ -1,4 +1,3 @@
-import requests
 import functools
 import random
 import logging
@@ -7,15 +6,27 @@ import dateparser
 import datetime
 import time
 import filetype
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field, replace
+from urllib.parse import urlparse
 from lxml import html
+from urllib3.util.retry import Retry
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor, Future
 from boofilsic.settings import LUMINATI_USERNAME, LUMINATI_PASSWORD, DEBUG, IMDB_API_KEY, SCRAPERAPI_KEY
 from boofilsic.settings import SPOTIFY_CREDENTIAL
+from boofilsic.settings import SCRAPE_CACHE_MAX_ENTRIES, SCRAPE_CACHE_TIMEOUT
+from boofilsic.settings import SCRAPE_POOL_SIZE, SCRAPE_MAX_RETRIES, SCRAPE_RETRY_BACKOFF_FACTOR
+from boofilsic.settings import SCRAPE_RATE_LIMITS, SCRAPE_DEFAULT_RATE_LIMIT, SCRAPE_IMAGE_WORKERS
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import cache
+from django.db import connection
 from common.models import SourceSiteEnum
+from common.utils import create_pooled_session, TimingMetrics
 from movies.models import Movie, MovieGenreEnum
 from movies.forms import MovieForm
 from books.models import Book
@@ -56,6 +67,192 @@ logger = logging.getLogger(__name__)
 scraper_registry = {}
 
 
+class ScraperTransport:
+    """
+    HTTP client shared by all scrapers. Requests to each host go through a
+    pooled session, are retried with backoff, rate limited to
+    `SCRAPE_RATE_LIMITS` requests per second, and timed by site.
+    """
+
+    # responses of these statuses are retried for idempotent methods
+    RETRY_STATUSES = (429, 502, 503, 504)
+    RETRY_METHODS = ('GET', 'HEAD')
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # in form of {host: session}
+        self.__sessions = {}
+        # in form of {host: luminati session id}, proxy connections are reused
+        # with the same session id, which is changed after failures
+        self.__proxy_session_ids = {}
+        # in form of {host: time when next request is allowed}
+        self.__next_request_times = {}
+        self.metrics = TimingMetrics()
+
+    def __get_session(self, host):
+        with self.__lock:
+            if host not in self.__sessions:
+                # only failed connections are retried by the adapter, which never
+                # reach the site, read timeouts are not retried since the request
+                # may have been served, and charged by paid apis like scraperapi
+                retry = Retry(
+                    total=SCRAPE_MAX_RETRIES,
+                    connect=SCRAPE_MAX_RETRIES,
+                    read=0,
+                    status=0,
+                    backoff_factor=SCRAPE_RETRY_BACKOFF_FACTOR,
+                )
+                self.__sessions[host] = create_pooled_session(SCRAPE_POOL_SIZE, retry)
+            return self.__sessions[host]
+
+    def __get_proxies(self, host):
+        with self.__lock:
+            session_id = self.__proxy_session_ids.setdefault(host, random.random())
+        proxy_url = ('http://%s-country-cn-session-%s:%s@zproxy.lum-superproxy.io:%d' %
+                     (LUMINATI_USERNAME, session_id, LUMINATI_PASSWORD, PORT))
+        return {
+            'http': proxy_url,
+            'https': proxy_url,
+        }
+
+    def __wait_for_rate_limit(self, host):
+        interval = 1 / SCRAPE_RATE_LIMITS.get(host, SCRAPE_DEFAULT_RATE_LIMIT)
+        with self.__lock:
+            now = time.monotonic()
+            request_time = max(now, self.__next_request_times.get(host, now))
+            self.__next_request_times[host] = request_time + interval
+        if request_time > now:
+            time.sleep(request_time - now)
+
+    def request(self, method, url, site=None, use_proxy=False, **kwargs):
+        """
+        Responses of `RETRY_STATUSES` are retried with backoff for idempotent
+        methods, every attempt waits for the rate limit of the host.
+        @param site: metrics are recorded by site, host of the url by default
+        @param use_proxy: send through luminati proxy
+        """
+        host = urlparse(url).netloc
+        kwargs.setdefault('timeout', TIMEOUT)
+        session = self.__get_session(host)
+        attempts = SCRAPE_MAX_RETRIES + 1 if method in self.RETRY_METHODS else 1
+        for attempt in range(attempts):
+            if attempt:
+                time.sleep(SCRAPE_RETRY_BACKOFF_FACTOR * 2 ** (attempt - 1))
+            if use_proxy:
+                kwargs['proxies'] = self.__get_proxies(host)
+            self.__wait_for_rate_limit(host)
+
+            start_time = time.monotonic()
+            is_error = True
+            try:
+                response = session.request(method, url, **kwargs)
+                is_error = response.status_code >= 400
+            finally:
+                elapsed = time.monotonic() - start_time
+                self.metrics.record(site or host, elapsed, is_error)
+                logger.debug(f"{method} {host} took {elapsed * 1000:.0f}ms")
+                if is_error and use_proxy:
+                    # try another exit next time
+                    with self.__lock:
+                        self.__proxy_session_ids.pop(host, None)
+            if response.status_code not in self.RETRY_STATUSES:
+                break
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def get_metrics(self):
+        return self.metrics.get_metrics()
+
+
+transport = ScraperTransport()
+
+# download cover images in background while pages are being parsed
+image_executor = ThreadPoolExecutor(max_workers=SCRAPE_IMAGE_WORKERS)
+
+
+@dataclass(frozen=True)
+class ScrapeResult:
+    """
+    Result of one scraping, scrapers keep no state of their own so that
+    the same site can be scraped concurrently.
+    """
+    # form data of the entity
+    data: dict
+    raw_img: bytes
+    img_ext: str
+    # form used to validate and save the data
+    form_class: type
+    # site specific data, like track urls of spotify albums
+    extras: dict = field(default_factory=dict)
+
+
+class ScrapeResultCache:
+    """
+    In-memory LRU cache of scrape results keyed by effective url, entries expire
+    after `timeout` seconds. Concurrent scrapings of the same url are coalesced
+    into one, others wait for its result. Results are shared, so their data
+    should not be mutated.
+    """
+
+    def __init__(self, max_entries, timeout):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        # in form of {url: (expire_time, result)}
+        self.__entries = OrderedDict()
+        # in form of {url: future}
+        self.__in_flight = {}
+        self.__lock = threading.Lock()
+
+    def get_or_scrape(self, url, scrape_func):
+        with self.__lock:
+            entry = self.__entries.get(url)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self.__entries.move_to_end(url)
+                    return entry[1]
+                del self.__entries[url]
+            future = self.__in_flight.get(url)
+            is_scraping = future is None
+            if is_scraping:
+                future = Future()
+                self.__in_flight[url] = future
+
+        if not is_scraping:
+            return future.result()
+
+        error = None
+        try:
+            result = scrape_func()
+            return result
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            # waiters are always woken up, even by exceptions like KeyboardInterrupt
+            with self.__lock:
+                del self.__in_flight[url]
+                if error is None:
+                    self.__entries[url] = (time.monotonic() + self.timeout, result)
+                    while len(self.__entries) > self.max_entries:
+                        self.__entries.popitem(last=False)
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+
+scrape_result_cache = ScrapeResultCache(SCRAPE_CACHE_MAX_ENTRIES, SCRAPE_CACHE_TIMEOUT)
+
+
 def log_url(func):
     """
     Catch exceptions and log then pass the exceptions.
@@ -73,6 +270,26 @@ def log_url(func):
 
     return wrapper
 
+def cache_result(func):
+    """
+    Serve results from `scrape_result_cache` by effective url.
+    First postion argument (except cls/self) of decorated function must be the url.
+    """
+    @functools.wraps(func)
+    def wrapper(cls, url, *args, **kwargs):
+        try:
+            effective_url = cls.get_effective_url(url)
+        except ValueError:
+            effective_url = None
+        if not effective_url:
+            # leave invalid urls to the scraper
+            return func(cls, url, *args, **kwargs)
+        return scrape_result_cache.get_or_scrape(
+            effective_url, lambda: func(cls, url, *args, **kwargs))
+
+    return wrapper
+
+
 def parse_date(raw_str):
     return dateparser.parse(
         raw_str, 
@@ -98,10 +315,6 @@ class AbstractScraper:
     form_class = None
     # used to extract effective url
     regex = None
-    # scraped raw image
-    raw_img = None
-    # scraped raw data
-    raw_data = {}
 
     def __init_subclass__(cls, **kwargs):
         # this statement initialize the subclasses
@@ -118,7 +331,7 @@ class AbstractScraper:
             cls.scrape), "scaper must have method `.scrape()`"
 
         # decorate the scrape method
-        cls.scrape = classmethod(log_url(cls.scrape))
+        cls.scrape = classmethod(cache_result(log_url(cls.scrape)))
         
         # register scraper
         if isinstance(cls.host, list):
@@ -131,8 +344,7 @@ class AbstractScraper:
         """
         Scrape/request model schema specified data from given url and return it.
         Implementations of subclasses to this method would be decorated as class method.
-        return (data_dict, image)
-        Should set the `raw_data` and the `raw_img`
+        return ScrapeResult
         """
         raise NotImplementedError("Subclass should implement this method")
 
@@ -146,21 +358,21 @@ class AbstractScraper:
             raise ValueError("not valid url")
         return url[0]
 
+    @classmethod
+    def get_request_host(cls, url):
+        """
+        Host that pages of the url are actually requested from,
+        by which concurrent scrapings are limited.
+        """
+        return urlparse(url).netloc
+
     @classmethod
     def download_page(cls, url, headers):
         url = cls.get_effective_url(url)
 
-        session_id = random.random()
-        proxy_url = ('http://%s-country-cn-session-%s:%s@zproxy.lum-superproxy.io:%d' %
-                     (LUMINATI_USERNAME, session_id, LUMINATI_PASSWORD, PORT))
-        proxies = {
-            'http': proxy_url,
-            'https': proxy_url,
-        }
         # if DEBUG:
-        #     proxies = None
-        r = requests.get(url, proxies=proxies,
-                         headers=headers, timeout=TIMEOUT)
+        #     use_proxy = False
+        r = transport.get(url, site=cls.site_name, use_proxy=True, headers=headers)
 
         if r.status_code != 200:
             raise RuntimeError(f"download page failed, status code {r.status_code}")
@@ -170,21 +382,15 @@ class AbstractScraper:
 
     @classmethod
     def download_image(cls, url):
-        if url is None:
-            return
         raw_img = None
-        session_id = random.random()
-        proxy_url = ('http://%s-country-cn-session-%s:%s@zproxy.lum-superproxy.io:%d' %
-                     (LUMINATI_USERNAME, session_id, LUMINATI_PASSWORD, PORT))
-        proxies = {
-            'http': proxy_url,
-            'https': proxy_url,
-        }
+        ext = None
         # if DEBUG:
-        #     proxies = None
+        #     use_proxy = False
         if url:
-            img_response = requests.get(
+            img_response = transport.get(
                 url,
+                site=cls.site_name,
+                use_proxy=True,
                 headers={
                     'accept': 'image/webp,image/apng,image/*,*/*;q=0.8',
                     'accept-encoding': 'gzip, deflate',
@@ -193,27 +399,48 @@ class AbstractScraper:
                     'cache-control': 'no-cache',
                     'dnt': '1',
                 },
-                proxies=proxies,
-                timeout=TIMEOUT,
             )
             if img_response.status_code == 200:
                 raw_img = img_response.content
                 content_type = img_response.headers.get('Content-Type')
                 ext = filetype.get_type(mime=content_type.partition(';')[0].strip()).extension
-            else:
-                ext = None
         return raw_img, ext
 
     @classmethod
-    def save(cls, request_user):
+    def download_image_async(cls, url):
+        """
+        Start downloading in background, so that it overlaps with parsing.
+        Return a future of (raw_img, ext).
+        """
+        return image_executor.submit(cls.download_image, url)
+
+    @classmethod
+    def get_first_image(cls, futures):
+        """
+        Wait for futures of `download_image_async`, return (raw_img, ext) of
+        the first one in order that succeeded, (None, None) if all failed.
+        """
+        for future in futures:
+            try:
+                raw_img, ext = future.result()
+            except Exception as e:
+                logger.error("Exception during downloading image", exc_info=e)
+                continue
+            if raw_img is not None:
+                for rest_future in futures:
+                    rest_future.cancel()
+                return raw_img, ext
+        return None, None
+
+    @classmethod
+    def save(cls, result, request_user):
         entity_cover = {
-            'cover': SimpleUploadedFile('temp.' + cls.img_ext, cls.raw_img)
-        }
-        form = cls.form_class(cls.raw_data, entity_cover)
+            'cover': SimpleUploadedFile('temp.' + result.img_ext, result.raw_img)
+        } if result.raw_img else None
+        form = result.form_class(result.data, entity_cover)
         if form.is_valid():
             form.instance.last_editor = request_user
             form.save()
-            cls.instance = form.instance
         else:
             logger.error(str(form.errors))
             raise ValidationError("Form invalid.")
@@ -221,13 +448,20 @@ class AbstractScraper:
 
 
 class DoubanScrapperMixin:
+    # pages are requested through scraperapi
+    scraper_api_host = 'api.scraperapi.com'
+
+    @classmethod
+    def get_request_host(cls, url):
+        return cls.scraper_api_host
+
     @classmethod
     def download_page(cls, url, headers):
         url = cls.get_effective_url(url)
 
-        scraper_api_endpoint = f'http://api.scraperapi.com?api_key={SCRAPERAPI_KEY}&url={url}'
+        scraper_api_endpoint = f'http://{cls.scraper_api_host}?api_key={SCRAPERAPI_KEY}&url={url}'
 
-        r = requests.get(scraper_api_endpoint, timeout=TIMEOUT)
+        r = transport.get(scraper_api_endpoint, site=cls.site_name)
 
         if r.status_code != 200:
             raise RuntimeError(f"download page failed, status code {r.status_code}")
@@ -249,6 +483,11 @@ class DoubanBookScraper(DoubanScrapperMixin, AbstractScraper):
         headers['Host'] = self.host
         content = self.download_page(url, headers)
 
+        # download image in background
+        img_url_elem = content.xpath("//*[@id='mainpic']/a/img/@src")
+        img_url = img_url_elem[0].strip() if img_url_elem else None
+        img_future = self.download_image_async(img_url)
+
         # parsing starts here
         try:
             title = content.xpath("/html/body//h1/span/text()")[0].strip()
@@ -330,10 +569,6 @@ class DoubanBookScraper(DoubanScrapperMixin, AbstractScraper):
         except:
             pass
 
-        img_url_elem = content.xpath("//*[@id='mainpic']/a/img/@src")
-        img_url = img_url_elem[0].strip() if img_url_elem else None
-        raw_img, ext = self.download_image(img_url)
-
         # there are two html formats for authors and translators
         authors_elem = content.xpath("""//div[@id='info']//span[text()='作者:']/following-sibling::br[1]/
             preceding-sibling::a[preceding-sibling::span[text()='作者:']]/text()""")
@@ -393,8 +628,8 @@ class DoubanBookScraper(DoubanScrapperMixin, AbstractScraper):
             'source_site': self.site_name,
             'source_url': self.get_effective_url(url),
         }
-        self.raw_data, self.raw_img, self.img_ext = data, raw_img, ext
-        return data, raw_img
+        raw_img, ext = img_future.result()
+        return ScrapeResult(data, raw_img, ext, self.form_class)
 
 
 class DoubanMovieScraper(DoubanScrapperMixin, AbstractScraper):
@@ -410,6 +645,11 @@ class DoubanMovieScraper(DoubanScrapperMixin, AbstractScraper):
         headers['Host'] = self.host
         content = self.download_page(url, headers)
 
+        # download image in background
+        img_url_elem = content.xpath("//img[@rel='v:image']/@src")
+        img_url = img_url_elem[0].strip() if img_url_elem else None
+        img_future = self.download_image_async(img_url)
+
         # parsing starts here
         try:
             raw_title = content.xpath(
@@ -542,10 +782,6 @@ class DoubanMovieScraper(DoubanScrapperMixin, AbstractScraper):
         brief = '\n'.join([e.strip() for e in brief_elem[0].xpath(
             './text()')]) if brief_elem else None
 
-        img_url_elem = content.xpath("//img[@rel='v:image']/@src")
-        img_url = img_url_elem[0].strip() if img_url_elem else None
-        raw_img, ext = self.download_image(img_url)
-
         data = {
             'title': title,
             'orig_title': orig_title,
@@ -569,8 +805,8 @@ class DoubanMovieScraper(DoubanScrapperMixin, AbstractScraper):
             'source_site': self.site_name,
             'source_url': self.get_effective_url(url),
         }
-        self.raw_data, self.raw_img, self.img_ext = data, raw_img, ext
-        return data, raw_img
+        raw_img, ext = img_future.result()
+        return ScrapeResult(data, raw_img, ext, self.form_class)
 
 
 class DoubanAlbumScraper(DoubanScrapperMixin, AbstractScraper):
@@ -586,6 +822,11 @@ class DoubanAlbumScraper(DoubanScrapperMixin, AbstractScraper):
         headers['Host'] = self.host
         content = self.download_page(url, headers)
 
+        # download image in background
+        img_url_elem = content.xpath("//div[@id='mainpic']//img/@src")
+        img_url = img_url_elem[0].strip() if img_url_elem else None
+        img_future = self.download_image_async(img_url)
+
         # parsing starts here
         try:
             title = content.xpath("//h1/span/text()")[0].strip()
@@ -650,10 +891,6 @@ class DoubanAlbumScraper(DoubanScrapperMixin, AbstractScraper):
         if other_elem:
             other_info['碟片数'] = other_elem[0].strip()
 
-        img_url_elem = content.xpath("//div[@id='mainpic']//img/@src")
-        img_url = img_url_elem[0].strip() if img_url_elem else None
-        raw_img, ext = self.download_image(img_url)
-
         data = {
             'title': title,
             'artist': artist,
@@ -667,12 +904,9 @@ class DoubanAlbumScraper(DoubanScrapperMixin, AbstractScraper):
             'source_site': self.site_name,
             'source_url': self.get_effective_url(url),
         }
-        self.raw_data, self.raw_img, self.img_ext = data, raw_img, ext
-        return data, raw_img
-
+        raw_img, ext = img_future.result()
+        return ScrapeResult(data, raw_img, ext, self.form_class)
 
-spotify_token = None
-spotify_token_expire_time = time.time()
 
 class SpotifyTrackScraper(AbstractScraper):
     site_name = SourceSiteEnum.SPOTIFY.value
@@ -686,19 +920,15 @@ class SpotifyTrackScraper(AbstractScraper):
         """
         Request from API, not really scraping
         """
-        global spotify_token, spotify_token_expire_time
-
-        if spotify_token is None or is_spotify_token_expired():
-            invoke_spotify_token()
         effective_url = self.get_effective_url(url)
         if effective_url is None:
             raise ValueError("not valid url")
 
         api_url = self.get_api_url(effective_url)
         headers = {
-            'Authorization': f"Bearer {spotify_token}"
+            'Authorization': f"Bearer {spotify_token_manager.get_token()}"
         }
-        r = requests.get(api_url, headers=headers)
+        r = transport.get(api_url, site=self.site_name, headers=headers)
         res_data = r.json()
 
         artist = []
@@ -718,7 +948,7 @@ class SpotifyTrackScraper(AbstractScraper):
         else:
             isrc = None
 
-        raw_img, ext = self.download_image(res_data['album']['images'][0]['url'])
+        img_future = self.download_image_async(res_data['album']['images'][0]['url'])
         
         data = {
             'title': title,
@@ -733,8 +963,8 @@ class SpotifyTrackScraper(AbstractScraper):
             'source_site': self.site_name,
             'source_url': effective_url,
         }
-        self.raw_data, self.raw_img, self.img_ext = data, raw_img, ext
-        return data, raw_img
+        raw_img, ext = img_future.result()
+        return ScrapeResult(data, raw_img, ext, self.form_class)
 
     @classmethod
     def get_effective_url(cls, raw_url):
@@ -758,23 +988,22 @@ class SpotifyAlbumScraper(AbstractScraper):
 
     regex = re.compile(r"(?<=https://open\.spotify\.com/album/)[a-zA-Z0-9]+")
 
+    # max concurrent requests when scraping tracks of an album
+    TRACK_SCRAPING_WORKERS = 3
+
     def scrape(self, url):
         """
         Request from API, not really scraping
         """
-        global spotify_token, spotify_token_expire_time
-
-        if spotify_token is None or is_spotify_token_expired():
-            invoke_spotify_token()
         effective_url = self.get_effective_url(url)
         if effective_url is None:
             raise ValueError("not valid url")
 
         api_url = self.get_api_url(effective_url)
         headers = {
-            'Authorization': f"Bearer {spotify_token}"
+            'Authorization': f"Bearer {spotify_token_manager.get_token()}"
         }
-        r = requests.get(api_url, headers=headers)
+        r = transport.get(api_url, site=self.site_name, headers=headers)
         res_data = r.json()
 
         artist = []
@@ -810,7 +1039,7 @@ class SpotifyAlbumScraper(AbstractScraper):
             # bar code
             other_info['UPC'] = res_data['external_ids']['upc']
 
-        raw_img, ext = self.download_image(res_data['images'][0]['url'])
+        img_future = self.download_image_async(res_data['images'][0]['url'])
 
         data = {
             'title': title,
@@ -826,11 +1055,9 @@ class SpotifyAlbumScraper(AbstractScraper):
             'source_url': effective_url,
         }
 
-        # set tracks_data, used for adding tracks
-        self.track_urls = track_urls
-
-        self.raw_data, self.raw_img, self.img_ext = data, raw_img, ext
-        return data, raw_img
+        raw_img, ext = img_future.result()
+        # track urls are used for adding tracks
+        return ScrapeResult(data, raw_img, ext, self.form_class, {'track_urls': track_urls})
 
     @classmethod
     def get_effective_url(cls, raw_url):
@@ -841,11 +1068,11 @@ class SpotifyAlbumScraper(AbstractScraper):
             return None
 
     @classmethod
-    def save(cls, request_user):
-        form = super().save(request_user)
+    def save(cls, result, request_user):
+        form = super().save(result, request_user)
         task = Thread(
             target=cls.add_tracks,
-            args=(form.instance, request_user),
+            args=(form.instance, result.extras['track_urls'], request_user),
             daemon=True
         )
         task.start()
@@ -856,24 +1083,25 @@ class SpotifyAlbumScraper(AbstractScraper):
         return "https://api.spotify.com/v1/albums/" + cls.regex.findall(url)[0]
 
     @classmethod
-    def add_tracks(cls, album: Album, request_user):
+    def add_tracks(cls, album: Album, track_urls, request_user):
         to_be_updated_tracks = []
-        for track_url in cls.track_urls:
-            track = cls.get_track_or_none(track_url)
-            # seems lik if fire too many requests at the same time 
-            # spotify would limit access
-            if track is None:
-                task = Thread(
-                    target=cls.scrape_and_save_track,
-                    args=(track_url, album, request_user),
-                    daemon=True
-                )
-                task.start()
-                task.join()
-            else:
-                to_be_updated_tracks.append(track)
+        # seems lik if fire too many requests at the same time 
+        # spotify would limit access
+        with ThreadPoolExecutor(max_workers=cls.TRACK_SCRAPING_WORKERS) as executor:
+            futures = {}
+            for track_url in track_urls:
+                track = cls.get_track_or_none(track_url)
+                if track is None:
+                    futures[track_url] = executor.submit(
+                        cls.scrape_and_save_track, track_url, album, request_user)
+                else:
+                    to_be_updated_tracks.append(track)
+            for track_url, future in futures.items():
+                if future.exception() is not None:
+                    logger.error(f"Adding track failed URL: {track_url}")
         cls.bulk_update_track_album(to_be_updated_tracks, album, request_user)
-        
+        connection.close()
+
     @classmethod
     def get_track_or_none(cls, track_url: str):
         try:
@@ -884,9 +1112,13 @@ class SpotifyAlbumScraper(AbstractScraper):
         
     @classmethod
     def scrape_and_save_track(cls, url: str, album: Album, request_user):
-        data, img = SpotifyTrackScraper.scrape(url)
-        SpotifyTrackScraper.raw_data['album'] = album
-        SpotifyTrackScraper.save(request_user)
+        try:
+            result = SpotifyTrackScraper.scrape(url)
+            result = replace(result, data={**result.data, 'album': album})
+            SpotifyTrackScraper.save(result, request_user)
+        finally:
+            # executed in worker threads, each of which has its own connection
+            connection.close()
         
     @classmethod
     def bulk_update_track_album(cls, tracks, album, request_user):
@@ -894,35 +1126,36 @@ class SpotifyAlbumScraper(AbstractScraper):
             track.last_editor = request_user
             track.edited_time = timezone.now()
             track.album = album
+            track.search_text = track.get_search_text()
         Song.objects.bulk_update(tracks, [
             'last_editor',
             'edited_time',
-            'album'
+            'album',
+            'search_text',
         ])
 
 
-def is_spotify_token_expired():
-    global spotify_token_expire_time
-    return True if spotify_token_expire_time <= time.time() else False
+class SpotifyTokenManager:
+    """
+    Share the access token of spotify API between threads, and between processes
+    through the cache. The token is refreshed `REFRESH_MARGIN` seconds before it
+    expires, so that no request is sent with a token about to expire.
+    """
+
+    CACHE_KEY = 'scraper:spotify:token'
+    # in seconds
+    REFRESH_MARGIN = 60
 
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__token = None
+        self.__expire_time = 0
 
-def invoke_spotify_token():
-    global spotify_token, spotify_token_expire_time
-    r = requests.post(
-        "https://accounts.spotify.com/api/token",
-        data={
-            "grant_type": "client_credentials"
-        },
-        headers={
-            "Authorization": f"Basic {SPOTIFY_CREDENTIAL}"
-        }
-    )
-    data = r.json()
-    if r.status_code == 401:
-        # token expired, try one more time
-        # this maybe caused by external operations,
-        # for example debugging using a http client
-        r = requests.post(
+    def __is_fresh(self, expire_time):
+        return expire_time - self.REFRESH_MARGIN > time.time()
+
+    def __request_token(self):
+        r = transport.post(
             "https://accounts.spotify.com/api/token",
             data={
                 "grant_type": "client_credentials"
@@ -931,12 +1164,47 @@ def invoke_spotify_token():
                 "Authorization": f"Basic {SPOTIFY_CREDENTIAL}"
             }
         )
+        if r.status_code == 401:
+            # token expired, try one more time
+            # this maybe caused by external operations,
+            # for example debugging using a http client
+            r = transport.post(
+                "https://accounts.spotify.com/api/token",
+                data={
+                    "grant_type": "client_credentials"
+                },
+                headers={
+                    "Authorization": f"Basic {SPOTIFY_CREDENTIAL}"
+                }
+            )
+        if r.status_code != 200:
+            raise Exception(f"Request to spotify API fails. Reason: {r.reason}")
         data = r.json()
-    elif r.status_code != 200:
-        raise Exception(f"Request to spotify API fails. Reason: {r.reason}")
-    # minus 2 for execution time error
-    spotify_token_expire_time = int(data['expires_in']) + time.time() - 2
-    spotify_token = data['access_token']
+        # minus 2 for execution time error
+        return data['access_token'], int(data['expires_in']) + time.time() - 2
+
+    def get_token(self):
+        token, expire_time = self.__token, self.__expire_time
+        if token is not None and self.__is_fresh(expire_time):
+            return token
+        with self.__lock:
+            # may be refreshed by other threads while waiting for the lock
+            if self.__token is not None and self.__is_fresh(self.__expire_time):
+                return self.__token
+            cached = cache.get(self.CACHE_KEY)
+            if cached is not None and self.__is_fresh(cached['expire_time']):
+                token, expire_time = cached['token'], cached['expire_time']
+            else:
+                token, expire_time = self.__request_token()
+                cache.set(self.CACHE_KEY, {
+                    'token': token,
+                    'expire_time': expire_time,
+                }, timeout=max(int(expire_time - time.time() - self.REFRESH_MARGIN), 1))
+            self.__token, self.__expire_time = token, expire_time
+            return token
+
+
+spotify_token_manager = SpotifyTokenManager()
 
 
 class ImdbMovieScraper(AbstractScraper):
@@ -954,7 +1222,7 @@ class ImdbMovieScraper(AbstractScraper):
             raise ValueError("not valid url")
 
         api_url = self.get_api_url(effective_url)
-        r = requests.get(api_url)
+        r = transport.get(api_url, site=self.site_name)
         res_data = r.json()
 
         if not res_data['type'] in ['Movie', 'TVSeries']:
@@ -998,7 +1266,7 @@ class ImdbMovieScraper(AbstractScraper):
         if res_data['awards']:
             other_info['奖项'] = res_data['awards'] 
 
-        raw_img, ext = self.download_image(res_data['image'])
+        img_future = self.download_image_async(res_data['image'])
 
         data = {
             'title': title,
@@ -1024,8 +1292,8 @@ class ImdbMovieScraper(AbstractScraper):
             'source_site': self.site_name,
             'source_url': effective_url,
         }
-        self.raw_data, self.raw_img, self.img_ext = data, raw_img, ext
-        return data, raw_img
+        raw_img, ext = img_future.result()
+        return ScrapeResult(data, raw_img, ext, self.form_class)
 
     @classmethod
     def get_effective_url(cls, raw_url):
@@ -1053,6 +1321,12 @@ class DoubanGameScraper(DoubanScrapperMixin, AbstractScraper):
         headers['Host'] = 'www.douban.com'
         content = self.download_page(url, headers)
 
+        # download image in background
+        img_url_elem = content.xpath(
+            "//div[@class='item-subject-info']/div[@class='pic']//img/@src")
+        img_url = img_url_elem[0].strip() if img_url_elem else None
+        img_future = self.download_image_async(img_url)
+
         try:
             raw_title = content.xpath(
                 "//div[@id='content']/h1/text()")[0].strip()
@@ -1090,11 +1364,6 @@ class DoubanGameScraper(DoubanScrapperMixin, AbstractScraper):
         brief_elem = content.xpath("//div[@class='mod item-desc']/p/text()")
         brief = '\n'.join(brief_elem) if brief_elem else None
 
-        img_url_elem = content.xpath(
-            "//div[@class='item-subject-info']/div[@class='pic']//img/@src")
-        img_url = img_url_elem[0].strip() if img_url_elem else None
-        raw_img, ext = self.download_image(img_url)
-
         data = {
             'title': title,
             'other_title': other_title,
@@ -1109,8 +1378,8 @@ class DoubanGameScraper(DoubanScrapperMixin, AbstractScraper):
             'source_url': self.get_effective_url(url),
         }
 
-        self.raw_data, self.raw_img, self.img_ext = data, raw_img, ext
-        return data, raw_img
+        raw_img, ext = img_future.result()
+        return ScrapeResult(data, raw_img, ext, self.form_class)
 
 
 class SteamGameScraper(AbstractScraper):
@@ -1126,7 +1395,14 @@ class SteamGameScraper(AbstractScraper):
         headers['Host'] = self.host
         headers['Cookie'] = "wants_mature_content=1; birthtime=754700401;"
         content = self.download_page(url, headers)
-        
+
+        header_img_url = content.xpath("//img[@class='game_header_image_full']/@src")[0]
+        # use header picture if there's no 600x900 picture
+        img_futures = [
+            self.download_image_async(header_img_url.replace("header.jpg", "library_600x900.jpg")),
+            self.download_image_async(header_img_url),
+        ]
+
         title = content.xpath("//div[@class='apphub_AppName']/text()")[0]
         developer = content.xpath("//div[@id='developers_list']/a/text()")
         publisher = content.xpath("//div[@class='glance_ctn']//div[@class='dev_row'][2]//a/text()")
@@ -1143,16 +1419,6 @@ class SteamGameScraper(AbstractScraper):
         brief = content.xpath(
             "//div[@class='game_description_snippet']/text()")[0].strip()
 
-        img_url = content.xpath(
-            "//img[@class='game_header_image_full']/@src"
-        )[0].replace("header.jpg", "library_600x900.jpg")
-        raw_img, ext = self.download_image(img_url)
-
-        # no 600x900 picture
-        if raw_img is None:
-            img_url = content.xpath("//img[@class='game_header_image_full']/@src")[0]
-            raw_img, ext = self.download_image(img_url)
-
         data = {
             'title': title,
             'other_title': None,
@@ -1167,8 +1433,8 @@ class SteamGameScraper(AbstractScraper):
             'source_url': self.get_effective_url(url),
         }
 
-        self.raw_data, self.raw_img, self.img_ext = data, raw_img, ext
-        return data, raw_img
+        raw_img, ext = self.get_first_image(img_futures)
+        return ScrapeResult(data, raw_img, ext, self.form_class)
 
 
 def find_entity(source_url):
@@ -1190,7 +1456,7 @@ class BangumiScraper(AbstractScraper):
     data_class = type("FakeDataClass", (object,), {})()
     data_class.objects = type("FakeObjectsClass", (object,), {})()
     data_class.objects.get = find_entity
-    # should be set at scrape_* method
+    # decided by the category of the page, see `scrape`
     form_class = ''
 
 
@@ -1206,26 +1472,25 @@ class BangumiScraper(AbstractScraper):
 
         # download image
         img_url = 'http:' + content.xpath("//div[@class='infobox']//img[1]/@src")[0]
-        raw_img, ext = self.download_image(img_url)
+        img_future = self.download_image_async(img_url)
 
         # Test category
         category_code = content.xpath("//div[@id='headerSearch']//option[@selected]/@value")[0]
         handler_map = {
-            '1': self.scrape_book,
-            '2': self.scrape_movie,
-            '3': self.scrape_album,
-            '4': self.scrape_game
+            '1': (self.scrape_book, BookForm),
+            '2': (self.scrape_movie, MovieForm),
+            '3': (self.scrape_album, AlbumForm),
+            '4': (self.scrape_game, GameForm),
         }
-        data = handler_map[category_code](self, content)
+        handler, form_class = handler_map[category_code]
+        data = handler(self, content)
         data['source_url'] = self.get_effective_url(url)
 
-        self.raw_data, self.raw_img, self.img_ext = data, raw_img, ext
-        return data, raw_img
+        raw_img, ext = img_future.result()
+        return ScrapeResult(data, raw_img, ext, form_class)
 
 
     def scrape_game(self, content):
-        self.data_class = Game
-        self.form_class = GameForm
 
         title_elem = content.xpath("//a[@property='v:itemreviewed']/text()")
         if not title_elem:
@@ -1344,18 +1609,12 @@ class BangumiScraper(AbstractScraper):
         return data
 
     def scrape_movie(self, content):
-        self.data_class = Movie
-        self.form_class = MovieForm
         raise NotImplementedError
 
     def scrape_book(self, content):
-        self.data_class = Book
-        self.form_class = BookForm
         raise NotImplementedError
 
     def scrape_album(self, content):
-        self.data_class = Album
-        self.form_class = AlbumForm
         raise NotImplementedError
 
 
@@ -1,3 +1,169 @@
-from django.test import TestCase
+import threading
+from django.test import TestCase, SimpleTestCase
+from books.models import Book, BookMark, BookReview, BookTag
+from music.models import Album, Song
+from users.models import User
+from .apps import populate_search_text, populate_tag_frequencies, populate_markdown_contents
+from .models import MarkStatusEnum
+from .scraper import ScrapeResultCache
+from .views import keyword_condition
 
-# Create your tests here.
+
+class KeywordSearchTest(TestCase):
+
+    def setUp(self):
+        self.album = Album.objects.create(
+            title='只爱陌生人',
+            artist=['王菲'],
+            source_url='https://music.douban.com/subject/1/',
+            source_site='douban',
+        )
+        self.song = Song.objects.create(
+            title='Eyes On Me',
+            artist=['Faye Wong'],
+            album=self.album,
+            source_url='https://music.douban.com/subject/2/',
+            source_site='douban',
+        )
+
+    def search(self, model_class, keyword):
+        return list(model_class.objects.filter(keyword_condition(keyword)))
+
+    def test_short_keywords_match_substrings(self):
+        # too short to have a trigram, yet matched in any searchable field
+        self.assertEqual(self.search(Album, '王菲'), [self.album])
+        self.assertEqual(self.search(Album, '陌生'), [self.album])
+        self.assertEqual(self.search(Song, 'on'), [self.song])
+        self.assertEqual(self.search(Album, '刘'), [])
+
+    def test_keywords_are_case_insensitive(self):
+        self.assertEqual(self.search(Song, 'faye WONG'), [self.song])
+
+    def test_songs_are_searchable_by_album_title(self):
+        self.assertEqual(self.search(Song, '陌生人'), [self.song])
+
+        album = Album.objects.get(pk=self.album.pk)
+        album.title = '寓言'
+        album.save()
+        self.assertEqual(self.search(Song, '陌生人'), [])
+        self.assertEqual(self.search(Song, '寓言'), [self.song])
+
+    def test_songs_are_not_refreshed_unless_album_title_changes(self):
+        album = Album.objects.get(pk=self.album.pk)
+        album.update_rating(None, 8)
+        with self.assertNumQueries(1):
+            album.update_rating(8, 6)
+
+    def test_missing_search_text_is_filled_after_migrating(self):
+        # entities created before search text was added
+        Album.objects.update(search_text='')
+        Song.objects.update(search_text='')
+        self.assertEqual(self.search(Song, '陌生人'), [])
+
+        populate_search_text(None, verbosity=0)
+        self.assertEqual(self.search(Album, '王菲'), [self.album])
+        self.assertEqual(self.search(Song, '陌生人'), [self.song])
+
+
+class TagFrequencyBackfillTest(TestCase):
+
+    def test_tag_frequencies_are_filled_after_migrating(self):
+        book = Book.objects.create(
+            title='book', source_url='https://book.douban.com/subject/1/', source_site='douban')
+        # tags created before frequencies were added
+        for i, contents in enumerate([['小说', '日本'], ['小说']]):
+            user = User.objects.create(
+                username=f'test{i}', mastodon_id=i, mastodon_site='example.org')
+            mark = BookMark.objects.create(
+                owner=user, book=book, status=MarkStatusEnum.COLLECT, is_private=False)
+            for content in contents:
+                BookTag.objects.create(content=content, book=book, mark=mark)
+        self.assertEqual(list(book.get_tag_list(5)), [])
+
+        populate_tag_frequencies(None, verbosity=0)
+        self.assertEqual(list(book.get_tag_list(5)), [
+            {'content': '小说', 'tag_frequency': 2},
+            {'content': '日本', 'tag_frequency': 1},
+        ])
+
+        # nothing is counted twice when migrating again
+        populate_tag_frequencies(None, verbosity=0)
+        self.assertEqual(book.get_tag_list(1)[0]['tag_frequency'], 2)
+
+
+class MarkdownContentBackfillTest(TestCase):
+
+    def test_markdown_contents_are_rendered_after_migrating(self):
+        user = User.objects.create(
+            username='test', mastodon_id=1, mastodon_site='example.org')
+        book = Book.objects.create(
+            title='book', source_url='https://book.douban.com/subject/1/', source_site='douban')
+        review = BookReview.objects.create(
+            owner=user, book=book, is_private=False, title='review', content='**好看**')
+        # reviews saved before rendered contents were added
+        BookReview.objects.update(content_html='', excerpt='')
+
+        populate_markdown_contents(None, verbosity=0)
+        review.refresh_from_db()
+        self.assertEqual(review.content_html, '<p><strong>好看</strong></p>')
+        self.assertEqual(review.excerpt.strip(), '好看')
+
+
+class Interrupted(BaseException):
+    pass
+
+
+class ScrapeResultCacheTest(SimpleTestCase):
+    url = 'https://book.douban.com/subject/1/'
+
+    def setUp(self):
+        self.cache = ScrapeResultCache(10, 60)
+        self.started = threading.Event()
+        self.finish = threading.Event()
+        self.results = []
+
+    def slow_scrape(self, result):
+        def scrape():
+            self.started.set()
+            self.finish.wait(5)
+            if isinstance(result, BaseException):
+                raise result
+            return result
+        return scrape
+
+    def get_in_thread(self, scrape_func):
+        def get():
+            try:
+                self.results.append(self.cache.get_or_scrape(self.url, scrape_func))
+            except BaseException as e:
+                self.results.append(e)
+        thread = threading.Thread(target=get)
+        thread.start()
+        return thread
+
+    def test_concurrent_scrapings_are_coalesced(self):
+        scraping = self.get_in_thread(self.slow_scrape('result'))
+        self.started.wait(5)
+        waiting = self.get_in_thread(lambda: self.fail("scraped twice"))
+        # let the waiter reach the in flight scraping
+        waiting.join(0.2)
+        self.finish.set()
+        scraping.join(5)
+        waiting.join(5)
+        self.assertEqual(self.results, ['result', 'result'])
+        self.assertEqual(self.cache.get_or_scrape(self.url, lambda: 'another'), 'result')
+
+    def test_waiters_are_woken_up_by_any_exception(self):
+        error = Interrupted()
+        scraping = self.get_in_thread(self.slow_scrape(error))
+        self.started.wait(5)
+        waiting = self.get_in_thread(lambda: self.fail("scraped twice"))
+        # let the waiter reach the in flight scraping
+        waiting.join(0.2)
+        self.finish.set()
+        scraping.join(5)
+        waiting.join(5)
+        self.assertFalse(waiting.is_alive())
+        self.assertEqual(self.results, [error, error])
+        # failures are not cached
+        self.assertEqual(self.cache.get_or_scrape(self.url, lambda: 'result'), 'result')
@@ -1,5 +1,12 @@
+import os
+import sys
 import uuid
+import threading
+import requests
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
 from django.utils import timezone
+from django.core.paginator import Paginator
 
 class PageLinksGenerator:
     # TODO inherit django paginator
@@ -60,6 +67,129 @@ class PageLinksGenerator:
         # assert self.has_prev is not None and self.has_next is not None
 
 
+class CountedPaginator(Paginator):
+    """
+    Paginator with the total count known beforehand, e.g. read from denormalized stats,
+    so that no COUNT query is made.
+    If a page shows the count is wrong, `on_miscount` is called to correct where
+    the count is from, and the count is corrected, by a COUNT query if necessary.
+    """
+    def __init__(self, object_list, per_page, count, on_miscount=None, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        # overrides the cached property
+        self.count = count
+        self.on_miscount = on_miscount
+
+    def page(self, number):
+        """
+        Objects are sliced by page size instead of the count, so that
+        a short or an overfull last page shows the count is wrong.
+        """
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        object_list = list(self.object_list[bottom:bottom + self.per_page])
+        top = bottom + len(object_list)
+        if len(object_list) == self.per_page:
+            # unknown if there are more objects than counted
+            count = self.count if top <= self.count else None
+        elif object_list or number == 1:
+            count = top
+        else:
+            # unknown how many pages are there before
+            count = None
+        if count != self.count:
+            if self.on_miscount is not None:
+                self.on_miscount()
+            self.count = count if count is not None else self.object_list.count()
+            # recalculated by the corrected count
+            self.__dict__.pop('num_pages', None)
+            # raises EmptyPage if the page is gone, for which `get_page` returns the last page
+            number = self.validate_number(number)
+        return self._get_page(object_list, number, self)
+
+
+def bulk_update_in_batches(queryset, fields, update, batch_size):
+    """
+    Call `update` on every instance of the queryset, then save given fields
+    with one bulk UPDATE for each batch. Returns the number of updated instances.
+    """
+    updated = 0
+    batch = []
+    for instance in queryset.iterator(chunk_size=batch_size):
+        update(instance)
+        batch.append(instance)
+        if len(batch) >= batch_size:
+            queryset.model.objects.bulk_update(batch, fields)
+            updated += len(batch)
+            batch = []
+    if batch:
+        queryset.model.objects.bulk_update(batch, fields)
+        updated += len(batch)
+    return updated
+
+
+def create_pooled_session(pool_size, max_retries=0):
+    """
+    Create a session with pooled connections, meant to be shared by requests
+    to one host. Sessions are shared across requests and threads, so cookies
+    set by responses are never kept, cookies have to be passed explicitly.
+    @param max_retries: int or urllib3 `Retry`, passed to the adapter
+    """
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=max_retries)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+
+class TimingMetrics:
+    """
+    Thread safe counters of requests and their time by name, e.g. by site.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # in form of {name: {'requests': n, 'errors': n, 'total_time': seconds, 'max_time': seconds}}
+        self.__metrics = {}
+
+    def record(self, name, elapsed, is_error=False, count=1):
+        """
+        @param elapsed: seconds taken by the requests
+        @param count: number of requests made in the elapsed time
+        """
+        with self.__lock:
+            metrics = self.__metrics.setdefault(
+                name, {'requests': 0, 'errors': 0, 'total_time': 0, 'max_time': 0})
+            metrics['requests'] += count
+            metrics['errors'] += int(is_error)
+            metrics['total_time'] += elapsed
+            metrics['max_time'] = max(metrics['max_time'], elapsed)
+
+    def get_metrics(self):
+        """
+        Return a copy of metrics, with average time in seconds added.
+        """
+        with self.__lock:
+            return {
+                name: dict(metrics, avg_time=metrics['total_time'] / metrics['requests'])
+                for name, metrics in self.__metrics.items() if metrics['requests']
+            }
+
+
+def is_server_process():
+    """
+    Whether this process serves requests, i.e. not a management command
+    other than runserver, nor the reloader process of runserver.
+    Background workers should only be started in such processes.
+    """
+    if os.path.basename(sys.argv[0]) not in ('manage.py', 'django-admin', 'django-admin.py'):
+        return True
+    if sys.argv[1:2] != ['runserver']:
+        return False
+    return '--noreload' in sys.argv or os.environ.get('RUN_MAIN') == 'true'
+
+
 def ChoicesDictGenerator(choices_enum):
     choices_dict = {}
     for attr in dir(choices_enum):
@@ -1,6 +1,4 @@
-import operator
 import logging
-from difflib import SequenceMatcher
 from urllib.parse import urlparse
 from django.shortcuts import render, redirect, reverse
 from django.contrib.auth.decorators import login_required
@@ -8,7 +6,9 @@ from django.utils.translation import gettext_lazy as _
 from django.core.paginator import Paginator
 from django.core.validators import URLValidator
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
-from django.db.models import Q, Count
+from django.db.models import Q, Value, Func, CharField, FloatField, ExpressionWrapper
+from django.db.models.functions import Coalesce, Cast
+from django.contrib.postgres.search import TrigramSimilarity
 from django.http import HttpResponseBadRequest
 from books.models import Book
 from movies.models import Movie
@@ -17,7 +17,7 @@ from music.models import Album, Song, AlbumMark, SongMark
 from users.models import Report, User, Preference
 from mastodon.decorators import mastodon_request_included
 from users.views import home as user_home
-from common.models import MarkStatusEnum
+from common.models import MarkStatusEnum, Entity
 from common.utils import PageLinksGenerator
 from common.scraper import scraper_registry
 from common.config import *
@@ -30,6 +30,81 @@ def home(request):
     return user_home(request, request.user.id)
 
 
+class ArrayToString(Func):
+    """ Join array field into a string so that it can be compared by trigram """
+    function = 'array_to_string'
+    template = "%(function)s(%(expressions)s, ' ')"
+    output_field = CharField()
+
+
+def keyword_condition(keyword):
+    """
+    Build the lookup of a search keyword, matching substrings of all `search_fields`.
+    pg_trgm can't extract any trigram from keywords shorter than 3 characters,
+    e.g. one or two CJK characters, the lookup falls back to a sequential scan
+    for them, the trigram index only speeds up longer keywords.
+    """
+    return Q(search_text__contains=keyword.lower())
+
+
+def calculate_similarity(keywords, tag, weighted_fields):
+    """
+    Build the expression of search result relevance.
+    When searching by keywords, it is the weighted trigram similarity of given fields
+    averaged by keywords, when searching by single tag it is the rating number.
+    @param weighted_fields: list of (field name or expression, weight)
+    """
+    if keywords:
+        similarity = Value(0.0, output_field=FloatField())
+        for keyword in keywords:
+            for field, weight in weighted_fields:
+                similarity = similarity + Value(weight, output_field=FloatField()) * Coalesce(
+                    TrigramSimilarity(field, keyword), Value(0.0, output_field=FloatField()))
+        return ExpressionWrapper(
+            similarity / Value(float(len(keywords)), output_field=FloatField()),
+            output_field=FloatField()
+        )
+    elif tag:
+        return Cast(Coalesce('rating_number', Value(0)), FloatField())
+    else:
+        return Value(0.0, output_field=FloatField())
+
+
+def annotate_search_result(queryset, similarity, category):
+    """
+    Reduce the queryset into rows of (id, similarity, category),
+    thus querysets of different entities can be combined with UNION.
+    """
+    return queryset.annotate(
+        similarity=similarity,
+        category=Value(category, output_field=CharField()),
+    ).values('id', 'similarity', 'category')
+
+
+def fetch_search_result(rows):
+    """
+    Fetch entities of given search result rows, keeping the order of rows.
+    """
+    category_mapping = Entity.get_category_mapping_dict()
+    ids = {}
+    for row in rows:
+        ids.setdefault(row['category'], []).append(row['id'])
+    entities = {}
+    for category, id_list in ids.items():
+        queryset = category_mapping[category].objects.all()
+        if category == 'song':
+            queryset = queryset.select_related('album')
+        for pk, entity in queryset.in_bulk(id_list).items():
+            entities[(category, pk)] = entity
+    result = []
+    for row in rows:
+        entity = entities.get((row['category'], row['id']))
+        if entity is not None:
+            entity.similarity = row['similarity']
+            result.append(entity)
+    return result
+
+
 @login_required
 def search(request):
     if request.method == 'GET':
@@ -78,38 +153,20 @@ def search(request):
             q = Q()
 
             for keyword in keywords:
-                q = q | Q(title__icontains=keyword)
-                q = q | Q(subtitle__icontains=keyword)
-                q = q | Q(orig_title__icontains=keyword)
+                q = q | keyword_condition(keyword)
             if tag:
                 q = q & Q(book_tags__content__iexact=tag)
 
             query_args.append(q)
             queryset = Book.objects.filter(*query_args).distinct()
 
-            def calculate_similarity(book):
-                if keywords:
-                    # search by keywords
-                    similarity, n = 0, 0
-                    for keyword in keywords:
-                        similarity += 1/2 * SequenceMatcher(None, keyword, book.title).quick_ratio() 
-                        + 1/3 * SequenceMatcher(None, keyword, book.orig_title).quick_ratio()
-                        + 1/6 * SequenceMatcher(None, keyword, book.subtitle).quick_ratio()
-                        n += 1
-                    book.similarity = similarity / n
-
-                elif tag:
-                    # search by single tag
-                    book.similarity = 0 if book.rating_number is None else book.rating_number
-                else:
-                    book.similarity = 0
-                return book.similarity
-            if len(queryset) > 0:
-                ordered_queryset = sorted(queryset, key=calculate_similarity, reverse=True)
-            else:
-                ordered_queryset = list(queryset)
-            return ordered_queryset
-            
+            similarity = calculate_similarity(keywords, tag, [
+                ('title', 1/2),
+                ('orig_title', 1/3),
+                ('subtitle', 1/6),
+            ])
+            return annotate_search_result(queryset, similarity, 'book')
+
         def movie_param_handler(**kwargs):
             # keywords
             keywords = kwargs.get('keywords')
@@ -120,36 +177,19 @@ def search(request):
             q = Q()
 
             for keyword in keywords:
-                q = q | Q(title__icontains=keyword)
-                q = q | Q(other_title__icontains=keyword)
-                q = q | Q(orig_title__icontains=keyword)
+                q = q | keyword_condition(keyword)
             if tag:
                 q = q & Q(movie_tags__content__iexact=tag)
 
             query_args.append(q)
             queryset = Movie.objects.filter(*query_args).distinct()
 
-            def calculate_similarity(movie):
-                if keywords:
-                    # search by name
-                    similarity, n = 0, 0
-                    for keyword in keywords:
-                        similarity += 1/2 * SequenceMatcher(None, keyword, movie.title).quick_ratio()
-                        + 1/4 * SequenceMatcher(None, keyword, movie.orig_title).quick_ratio()
-                        + 1/4 * SequenceMatcher(None, keyword, movie.other_title).quick_ratio()
-                        n += 1
-                    movie.similarity = similarity / n
-                elif tag:
-                    # search by single tag
-                    movie.similarity = 0 if movie.rating_number is None else movie.rating_number
-                else:
-                    movie.similarity = 0
-                return movie.similarity
-            if len(queryset) > 0:
-                ordered_queryset = sorted(queryset, key=calculate_similarity, reverse=True)
-            else:
-                ordered_queryset = list(queryset)
-            return ordered_queryset
+            similarity = calculate_similarity(keywords, tag, [
+                ('title', 1/2),
+                ('orig_title', 1/4),
+                (ArrayToString('other_title'), 1/4),
+            ])
+            return annotate_search_result(queryset, similarity, 'movie')
 
         def game_param_handler(**kwargs):
             # keywords
@@ -161,40 +201,20 @@ def search(request):
             q = Q()
 
             for keyword in keywords:
-                q = q | Q(title__icontains=keyword)
-                q = q | Q(other_title__icontains=keyword)
-                q = q | Q(developer__icontains=keyword)
-                q = q | Q(publisher__icontains=keyword)
+                q = q | keyword_condition(keyword)
             if tag:
                 q = q & Q(game_tags__content__iexact=tag)
 
             query_args.append(q)
             queryset = Game.objects.filter(*query_args).distinct()
 
-            def calculate_similarity(game):
-                if keywords:
-                    # search by name
-                    developer_dump = ' '.join(game.developer)
-                    publisher_dump = ' '.join(game.publisher)
-                    similarity, n = 0, 0
-                    for keyword in keywords:
-                        similarity += 1/2 * SequenceMatcher(None, keyword, game.title).quick_ratio()
-                        + 1/4 * SequenceMatcher(None, keyword, game.other_title).quick_ratio()
-                        + 1/16 * SequenceMatcher(None, keyword, developer_dump).quick_ratio()
-                        + 1/16 * SequenceMatcher(None, keyword, publisher_dump).quick_ratio()
-                        n += 1
-                    game.similarity = similarity / n
-                elif tag:
-                    # search by single tag
-                    game.similarity = 0 if game.rating_number is None else game.rating_number
-                else:
-                    game.similarity = 0
-                return game.similarity
-            if len(queryset) > 0:
-                ordered_queryset = sorted(queryset, key=calculate_similarity, reverse=True)
-            else:
-                ordered_queryset = list(queryset)
-            return ordered_queryset
+            similarity = calculate_similarity(keywords, tag, [
+                ('title', 1/2),
+                (ArrayToString('other_title'), 1/4),
+                (ArrayToString('developer'), 1/16),
+                (ArrayToString('publisher'), 1/16),
+            ])
+            return annotate_search_result(queryset, similarity, 'game')
 
         def music_param_handler(**kwargs):
             # keywords
@@ -207,65 +227,43 @@ def search(request):
 
             # search albums
             for keyword in keywords:
-                q = q | Q(title__icontains=keyword)
-                q = q | Q(artist__icontains=keyword)
+                q = q | keyword_condition(keyword)
             if tag:
                 q = q & Q(album_tags__content__iexact=tag)
 
             query_args.append(q)
             album_queryset = Album.objects.filter(*query_args).distinct()
+            album_similarity = calculate_similarity(keywords, tag, [
+                ('title', 1/2),
+                (ArrayToString('artist'), 1/2),
+            ])
 
-            # extra query args for songs
+            # search songs, album title is included in song's search text
             q = Q()
             for keyword in keywords:
-                q = q | Q(album__title__icontains=keyword)
-                q = q | Q(title__icontains=keyword)
-                q = q | Q(artist__icontains=keyword)
+                q = q | keyword_condition(keyword)
             if tag:
                 q = q & Q(song_tags__content__iexact=tag)
             query_args.clear()
             query_args.append(q)
             song_queryset = Song.objects.filter(*query_args).distinct()
-            queryset = list(album_queryset) + list(song_queryset)
-
-            def calculate_similarity(music):
-                if keywords:
-                    # search by name
-                    similarity, n = 0, 0
-                    artist_dump = ' '.join(music.artist)
-                    for keyword in keywords:
-                        if music.__class__ == Album:
-                            similarity += 1/2 * SequenceMatcher(None, keyword, music.title).quick_ratio() \
-                                + 1/2 * SequenceMatcher(None, keyword, artist_dump).quick_ratio()
-                        elif music.__class__ == Song:
-                            similarity += 1/2 * SequenceMatcher(None, keyword, music.title).quick_ratio() \
-                                + 1/6 * SequenceMatcher(None, keyword, artist_dump).quick_ratio() \
-                                + 1/6 * SequenceMatcher(None, keyword, music.album.title).quick_ratio()
-                        n += 1
-                    music.similarity = similarity / n
-                elif tag:
-                    # search by single tag
-                    music.similarity = 0 if music.rating_number is None else music.rating_number
-                else:
-                    music.similarity = 0
-                return music.similarity
-            if len(queryset) > 0:
-                ordered_queryset = sorted(queryset, key=calculate_similarity, reverse=True)
-            else:
-                ordered_queryset = list(queryset)
-            return ordered_queryset
+            song_similarity = calculate_similarity(keywords, tag, [
+                ('title', 1/2),
+                (ArrayToString('artist'), 1/6),
+                ('album__title', 1/6),
+            ])
+
+            return annotate_search_result(album_queryset, album_similarity, 'album').union(
+                annotate_search_result(song_queryset, song_similarity, 'song'),
+                all=True
+            )
 
         def all_param_handler(**kwargs):
             book_queryset = book_param_handler(**kwargs)
             movie_queryset = movie_param_handler(**kwargs)
             music_queryset = music_param_handler(**kwargs)
             game_queryset = game_param_handler(**kwargs)
-            ordered_queryset = sorted(
-                book_queryset + movie_queryset + music_queryset + game_queryset, 
-                key=operator.attrgetter('similarity'), 
-                reverse=True
-            )
-            return ordered_queryset
+            return book_queryset.union(movie_queryset, music_queryset, game_queryset, all=True)
 
         param_handler = {
             'book': book_param_handler,
@@ -288,13 +286,15 @@ def search(request):
                 keywords=keywords,
                 tag=tag
             )
+        # ranking and pagination are done by the database,
+        # only the rows of current page are fetched as entities
+        queryset = queryset.order_by('-similarity', 'category', 'id')
         paginator = Paginator(queryset, ITEMS_PER_PAGE)
         page_number = request.GET.get('page', default=1)
         items = paginator.get_page(page_number)
+        items.object_list = fetch_search_result(items.object_list)
         items.pagination = PageLinksGenerator(PAGE_LINK_NUMBER, page_number, paginator.num_pages)
-        for item in items:
-            item.tag_list = item.get_tags_manager().values('content').annotate(
-                tag_frequency=Count('content')).order_by('-tag_frequency')[:TAG_NUMBER_ON_LIST]
+        Entity.set_tag_lists(items, TAG_NUMBER_ON_LIST)
 
         return render(
             request,
@@ -343,8 +343,8 @@ def jump_or_scrape(request, url):
         except ObjectDoesNotExist:
             # scrape if not exists
             try:
-                scraper.scrape(url)
-                form = scraper.save(request_user=request.user)
+                result = scraper.scrape(url)
+                form = scraper.save(result, request_user=request.user)
             except Exception as e:
                 logger.error(f"Scrape Failed URL: {url}")
                 logger.error("Expections during saving scraped data:", exc_info=e)
@@ -4,7 +4,7 @@ from django.utils.translation import ugettext_lazy as _
 from django.db import models
 from django.core.serializers.json import DjangoJSONEncoder
 from django.shortcuts import reverse
-from common.models import Entity, Mark, Review, Tag
+from common.models import Entity, Mark, Review, Tag, TagFrequency
 from common.utils import ChoicesDictGenerator, GenerateDateUUIDMediaFilePath
 from boofilsic.settings import GAME_MEDIA_PATH_ROOT, DEFAULT_GAME_IMAGE
 from django.utils import timezone
@@ -70,6 +70,7 @@ class Game(Entity):
 
     cover = models.ImageField(_("封面"), upload_to=game_cover_path, default=DEFAULT_GAME_IMAGE, blank=True)
 
+    search_fields = ['title', 'other_title', 'developer', 'publisher']
 
 
     def __str__(self):
@@ -81,6 +82,9 @@ class Game(Entity):
     def get_tags_manager(self):
         return self.game_tags
 
+    def get_tag_frequencies_manager(self):
+        return self.game_tag_frequencies
+
     @property
     def verbose_category_name(self):
         return _("游戏")
@@ -119,3 +123,15 @@ class GameTag(Tag):
             models.UniqueConstraint(
                 fields=['content', 'mark'], name="unique_gamemark_tag")
         ]
+
+
+class GameTagFrequency(TagFrequency):
+    game = models.ForeignKey(Game, on_delete=models.CASCADE, related_name='game_tag_frequencies')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['game', 'content'], name="unique_game_tag_frequency")
+        ]
+        indexes = [
+            models.Index(fields=['game', '-frequency'], name='game_tag_frequency_idx'),
+        ]
@@ -1,5 +1,8 @@
 from django.urls import reverse_lazy
 from django.shortcuts import get_object_or_404
+from django.http import JsonResponse
+from common.scraper import transport
+from mastodon.api import cross_site_id_metrics
 from .models import Announcement
 from django.utils import timezone
 from django.utils.decorators import method_decorator
@@ -26,7 +29,8 @@ class AnnouncementListView(ListView):
     template_name = "management/list.html"
 
     def get_queryset(self):
-        return Announcement.objects.all().order_by('-pk')
+        # the list shows rendered contents only
+        return Announcement.objects.defer('content').order_by('-pk')
 
 
 @method_decorator(decorators, name='dispatch')
@@ -39,14 +43,14 @@ class AnnouncementDeleteView(DeleteView):
 @method_decorator(decorators, name='dispatch')
 class AnnouncementCreateView(CreateView):
     model = Announcement
-    fields = '__all__'
+    fields = ['title', 'content', 'slug']
     template_name = "management/create_update.html"
 
 
 @method_decorator(decorators, name='dispatch')
 class AnnouncementUpdateView(UpdateView):
     model = Announcement
-    fields = '__all__'
+    fields = ['title', 'content', 'slug']
     template_name = "management/create_update.html"
 
     def form_valid(self, form):
@@ -54,3 +58,14 @@ class AnnouncementUpdateView(UpdateView):
         return super().form_valid(form)
 
 
+@login_required
+@user_passes_test(lambda u: u.is_superuser)
+def metrics(request):
+    """
+    Request counts and timings of scrapers and cross site id lookups
+    in this process.
+    """
+    return JsonResponse({
+        'scrapers': transport.get_metrics(),
+        'cross_site_ids': cross_site_id_metrics.get_metrics(),
+    })
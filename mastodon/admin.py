@@ -57,3 +57,15 @@ class MastodonApplicationModelAdmin(admin.ModelAdmin):
 
 
 admin.site.register(CrossSiteUserInfo)
+
+
+@admin.register(Toot)
+class TootModelAdmin(admin.ModelAdmin):
+    # the token is the user's oauth credential, never shown to staff
+    exclude = ['token']
+    readonly_fields = [
+        'idempotency_key', 'status', 'attempts', 'last_error',
+        'next_attempt_time', 'created_time', 'published_time',
+    ]
+    list_display = ['__str__', 'created_time', 'next_attempt_time']
+    list_filter = ['status']
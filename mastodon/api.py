@@ -1,10 +1,22 @@
-import requests
 import string
 import random
 import functools
+import logging
+import time
+import hashlib
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from requests.exceptions import RequestException, Timeout
+from urllib3.util.retry import Retry
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
-from boofilsic.settings import MASTODON_TIMEOUT
+from boofilsic.settings import MASTODON_TIMEOUT, MASTODON_CONCURRENT_REQUESTS
+from boofilsic.settings import MASTODON_RELATIONSHIP_CACHE_TIMEOUT
+from boofilsic.settings import MASTODON_POOL_SIZE, MASTODON_MAX_RETRIES, MASTODON_RETRY_BACKOFF_FACTOR
+from boofilsic.settings import MASTODON_CIRCUIT_BREAKER_THRESHOLD, MASTODON_CIRCUIT_BREAKER_TIMEOUT
 from boofilsic.settings import CLIENT_NAME, APP_WEBSITE, REDIRECT_URIS
+from common.utils import create_pooled_session, TimingMetrics
 from .models import CrossSiteUserInfo
 
 # See https://docs.joinmastodon.org/methods/accounts/
@@ -47,26 +59,186 @@ API_CREATE_APP = '/api/v1/apps'
 API_SEARCH = '/api/v2/search'
 
 
-get = functools.partial(requests.get, timeout=MASTODON_TIMEOUT)
-post = functools.partial(requests.post, timeout=MASTODON_TIMEOUT)
+mastodon_logger = logging.getLogger("django.mastodon")
+
+
+class CircuitOpenError(Timeout):
+    """
+    Raised instead of sending the request when the site keeps failing,
+    subclass of Timeout so that it is handled the same way.
+    """
+    pass
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures, then refuses requests until
+    `timeout` seconds passed, after which one trial request is let through.
+    """
+
+    def __init__(self, threshold, timeout):
+        self.threshold = threshold
+        self.timeout = timeout
+        self.failures = 0
+        self.opened_time = None
+        self.lock = threading.Lock()
+
+    def check(self, domain):
+        with self.lock:
+            if self.opened_time is None:
+                return
+            if time.monotonic() - self.opened_time < self.timeout:
+                raise CircuitOpenError(f"too many failed requests to {domain}")
+            # half open, let the trial request through and
+            # wait for its result before others
+            self.opened_time = time.monotonic()
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_time = None
+
+    def record_failure(self, domain):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_time is None:
+                    mastodon_logger.warning(f"circuit to {domain} opened")
+                self.opened_time = time.monotonic()
+
+
+# pooled keep-alive sessions and circuit breakers, in form of {domain: object}
+sessions = {}
+circuit_breakers = {}
+sessions_lock = threading.Lock()
+
+
+def get_session(domain):
+    with sessions_lock:
+        if domain not in sessions:
+            retry = Retry(
+                total=MASTODON_MAX_RETRIES,
+                backoff_factor=MASTODON_RETRY_BACKOFF_FACTOR,
+                status_forcelist=[429, 500, 502, 503, 504],
+                raise_on_status=False,
+                # backoff only, a site asking for a long wait would keep
+                # the request thread asleep beyond the timeout otherwise
+                respect_retry_after_header=False,
+            )
+            sessions[domain] = create_pooled_session(MASTODON_POOL_SIZE, retry)
+            circuit_breakers[domain] = CircuitBreaker(
+                MASTODON_CIRCUIT_BREAKER_THRESHOLD, MASTODON_CIRCUIT_BREAKER_TIMEOUT)
+        return sessions[domain], circuit_breakers[domain]
+
+
+def request(method, url, **kwargs):
+    """
+    Send request through the pooled session of url's domain.
+    """
+    domain = urlparse(url).netloc
+    session, circuit_breaker = get_session(domain)
+    circuit_breaker.check(domain)
+    kwargs.setdefault('timeout', MASTODON_TIMEOUT)
+    try:
+        response = session.request(method, url, **kwargs)
+    except RequestException:
+        circuit_breaker.record_failure(domain)
+        raise
+    # rate limited sites are backed off the same way as failing ones
+    if response.status_code >= 500 or response.status_code == 429:
+        circuit_breaker.record_failure(domain)
+    else:
+        circuit_breaker.record_success()
+    return response
+
+
+get = functools.partial(request, 'GET')
+post = functools.partial(request, 'POST')
 
 
 # low level api below
 def get_relationships(site, id_list, token):
-    url = 'https://' + site + API_GET_RELATIONSHIPS
-    payload = {'id[]': id_list}
-    headers = {
-        'Authorization': f'Bearer {token}'
+    """
+    Relationships are cached for each (viewer, site, target id), only the
+    uncached ones are requested.
+    Return relationships in the same order as id_list.
+    """
+    if not isinstance(id_list, (list, tuple)):
+        id_list = [id_list]
+    key_prefix = get_relationships_cache_key_prefix(site, token)
+    cache_keys = {str(id): f"{key_prefix}:{id}" for id in id_list}
+    cached_relationships = cache.get_many(cache_keys.values())
+    missing_ids = [id for id, key in cache_keys.items() if key not in cached_relationships]
+
+    if missing_ids:
+        url = 'https://' + site + API_GET_RELATIONSHIPS
+        payload = {'id[]': missing_ids}
+        headers = {
+            'Authorization': f'Bearer {token}'
+        }
+        response = get(url, headers=headers, data=payload)
+        data = response.json()
+        if not isinstance(data, list):
+            # error message, return as is
+            return data
+        fetched_relationships = {
+            cache_keys[str(r['id'])]: r for r in data if str(r['id']) in cache_keys
+        }
+        cache.set_many(fetched_relationships, MASTODON_RELATIONSHIP_CACHE_TIMEOUT)
+        cached_relationships.update(fetched_relationships)
+
+    return [
+        cached_relationships.get(cache_keys[str(id)], get_default_relationship(id))
+        for id in id_list
+    ]
+
+
+def get_relationships_cache_key_prefix(site, token):
+    """
+    Cache key prefix of relationships viewed by the token owner,
+    changes when `clear_relationships_cache` is called.
+    """
+    token_hash = hashlib.sha256(token.encode()).hexdigest()[:32]
+    version = cache.get(f"mastodon:relationships:version:{token_hash}", 0)
+    return f"mastodon:relationships:{token_hash}:{version}:{site}"
+
+
+def clear_relationships_cache(token):
+    """
+    Invalidate all cached relationships viewed by the token owner.
+    """
+    token_hash = hashlib.sha256(token.encode()).hexdigest()[:32]
+    version_key = f"mastodon:relationships:version:{token_hash}"
+    # no timeout, otherwise an expired version may make stale entries visible again,
+    # incremented atomically so that concurrent invalidations are all counted
+    cache.add(version_key, 0, None)
+    try:
+        cache.incr(version_key)
+    except ValueError:
+        # evicted since added
+        cache.add(version_key, 1, None)
+
+
+def get_default_relationship(id):
+    """ used when mastodon returns no relationship for the id, e.g. account is gone """
+    return {
+        'id': str(id),
+        'following': False,
+        'followed_by': False,
+        'blocking': False,
+        'blocked_by': False,
+        'muting': False,
     }
-    response = get(url, headers=headers, data=payload)
-    return response.json()
 
 
-def post_toot(site, content, visibility, token, local_only=False):
+def post_toot(site, content, visibility, token, local_only=False, idempotency_key=None):
+    """
+    Pass the same `idempotency_key` when retrying to avoid duplicated toots.
+    """
     url = 'https://' + site + API_PUBLISH_TOOT
     headers = {
         'Authorization': f'Bearer {token}',
-        'Idempotency-Key': random_string_generator(16)
+        'Idempotency-Key': idempotency_key or random_string_generator(16)
     }
     payload = {
         'status': content,
@@ -167,6 +339,63 @@ def get_cross_site_id(target_user, target_site, token):
     return cross_site_info.site_id
 
 
+# time of concurrent cross site id lookups by target site, each is counted as
+# many requests as the missing ids
+cross_site_id_metrics = TimingMetrics()
+
+
+def get_cross_site_ids(target_users, target_site, token):
+    """
+    Bulk version of `get_cross_site_id`. Known ids are queried from local
+    database at once, the missing ones are searched on mastodon site concurrently.
+    Return dict of {target_user.pk: cross site id}, the value is None if not found.
+    """
+    cross_site_ids = {}
+    uid_users = {}
+    for user in target_users:
+        if user.mastodon_site == target_site:
+            cross_site_ids[user.pk] = user.mastodon_id
+        else:
+            uid_users[f"{user.username}@{user.mastodon_site}"] = user
+    if not uid_users:
+        return cross_site_ids
+
+    for cross_site_info in CrossSiteUserInfo.objects.filter(
+            uid__in=list(uid_users), target_site=target_site):
+        cross_site_ids[uid_users[cross_site_info.uid].pk] = cross_site_info.site_id
+
+    missing_uids = [uid for uid, user in uid_users.items() if user.pk not in cross_site_ids]
+    if not missing_uids:
+        return cross_site_ids
+
+    # mastodon requests, database is only accessed from this thread
+    start_time = time.monotonic()
+    with ThreadPoolExecutor(max_workers=min(MASTODON_CONCURRENT_REQUESTS, len(missing_uids))) as executor:
+        site_ids = list(executor.map(
+            lambda uid: get_site_id(
+                uid_users[uid].username, uid_users[uid].mastodon_site, target_site, token),
+            missing_uids
+        ))
+    elapsed = time.monotonic() - start_time
+    cross_site_id_metrics.record(target_site, elapsed, count=len(missing_uids))
+    mastodon_logger.info(
+        f"{len(missing_uids)} cross site id requests to {target_site} took {elapsed * 1000:.0f}ms")
+
+    new_infos = []
+    for uid, site_id in zip(missing_uids, site_ids):
+        user = uid_users[uid]
+        cross_site_ids[user.pk] = site_id if site_id else None
+        if site_id:
+            new_infos.append(CrossSiteUserInfo(
+                uid=uid,
+                target_site=target_site,
+                site_id=site_id,
+                local_id=user.id
+            ))
+    CrossSiteUserInfo.objects.bulk_create(new_infos, ignore_conflicts=True)
+    return cross_site_ids
+
+
 def check_visibility(user_owned_entity, token, visitor):
     """
     check if given user can see the user owned entity
@@ -1,5 +1,13 @@
 from django.apps import AppConfig
+from common.utils import is_server_process
 
 
 class MastodonConfig(AppConfig):
     name = 'mastodon'
+
+    def ready(self):
+        # toots are published by processes serving requests only, not by
+        # management commands, shells or the reloader of runserver
+        if is_server_process():
+            from mastodon.jobs import toot_publisher
+            toot_publisher.start()
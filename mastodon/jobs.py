@@ -0,0 +1,126 @@
+import logging
+import threading
+import uuid
+from datetime import timedelta
+from django.db import transaction, close_old_connections
+from django.db.models import F
+from django.utils import timezone
+from requests.exceptions import RequestException
+from boofilsic.settings import MASTODON_TIMEOUT, MASTODON_MAX_RETRIES
+from boofilsic.settings import MASTODON_TOOT_MAX_ATTEMPTS, MASTODON_TOOT_RETRY_INTERVAL
+from .api import post_toot
+from .models import Toot, TootStatusEnum
+
+__all__ = ['toot_publisher', 'enqueue_toot']
+
+logger = logging.getLogger("django.mastodon")
+
+
+class TootPublisher:
+    """
+    Publish pending toots of the outbox in a background thread. Toots are
+    claimed with a conditional update, so several processes can run it.
+    """
+
+    # in seconds
+    POLL_INTERVAL = 5
+    # a claimed toot is left alone by other publishers for this long
+    LEASE_TIME = MASTODON_TIMEOUT * (MASTODON_MAX_RETRIES + 1) * 2
+    BATCH_SIZE = 20
+
+    def __init__(self):
+        self.__wake_event = threading.Event()
+        self.__stop_event = threading.Event()
+
+    def __claim(self, toot):
+        return Toot.objects.filter(
+            pk=toot.pk, status=TootStatusEnum.PENDING, attempts=toot.attempts
+        ).update(
+            attempts=F('attempts') + 1,
+            next_attempt_time=timezone.now() + timedelta(seconds=self.LEASE_TIME)
+        ) == 1
+
+    def __publish(self, toot):
+        try:
+            response = post_toot(
+                toot.site, toot.content, toot.visibility, toot.token,
+                idempotency_key=toot.idempotency_key
+            )
+        except RequestException as e:
+            error = str(e)
+            retryable = True
+        else:
+            if response.status_code == 200:
+                toot.status = TootStatusEnum.PUBLISHED
+                toot.published_time = timezone.now()
+                toot.token = ''
+                toot.last_error = ''
+                toot.save(update_fields=['status', 'published_time', 'token', 'last_error'])
+                return
+            error = f"CODE:{response.status_code} {response.text}"
+            # client errors like revoked token won't be fixed by retrying
+            retryable = response.status_code == 429 or response.status_code >= 500
+
+        toot.attempts += 1
+        toot.last_error = error
+        if retryable and toot.attempts < MASTODON_TOOT_MAX_ATTEMPTS:
+            toot.next_attempt_time = timezone.now() + timedelta(
+                seconds=MASTODON_TOOT_RETRY_INTERVAL * 2 ** (toot.attempts - 1))
+            logger.warning(f"publishing toot {toot.pk} failed, will retry: {error}")
+        else:
+            toot.status = TootStatusEnum.FAILED
+            toot.token = ''
+            logger.error(f"publishing toot {toot.pk} failed: {error}")
+        toot.save(update_fields=['attempts', 'last_error', 'next_attempt_time', 'status', 'token'])
+
+    def publish_due_toots(self):
+        due_toots = Toot.objects.filter(
+            status=TootStatusEnum.PENDING,
+            next_attempt_time__lte=timezone.now()
+        ).order_by('next_attempt_time')[:self.BATCH_SIZE]
+        for toot in due_toots:
+            if self.__stop_event.is_set():
+                return
+            if self.__claim(toot):
+                self.__publish(toot)
+
+    def __run(self):
+        while not self.__stop_event.is_set():
+            try:
+                self.publish_due_toots()
+            except Exception as e:
+                logger.error(f"publishing toots failed: {e}")
+            finally:
+                close_old_connections()
+            self.__wake_event.wait(self.POLL_INTERVAL)
+            self.__wake_event.clear()
+
+    def notify(self):
+        self.__wake_event.set()
+
+    def stop(self):
+        self.__stop_event.set()
+        self.__wake_event.set()
+
+    def start(self):
+        threading.Thread(target=self.__run, daemon=True).start()
+
+
+toot_publisher = TootPublisher()
+
+
+def enqueue_toot(user, content, visibility, token):
+    """
+    Save the toot to the outbox and return immediately, the publisher is
+    woken up once the surrounding transaction commits.
+    """
+    toot = Toot.objects.create(
+        user=user,
+        site=user.mastodon_site,
+        content=content,
+        visibility=visibility,
+        token=token,
+        idempotency_key=uuid.uuid4().hex,
+    )
+    transaction.on_commit(toot_publisher.notify)
+    return toot
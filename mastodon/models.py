@@ -1,6 +1,7 @@
 from django.db import models
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
+from users.models import User
 
 
 class MastodonApplication(models.Model):
@@ -36,4 +37,41 @@ class CrossSiteUserInfo(models.Model):
         ]
 
     def __str__(self):
-        return f"{self.uid}({self.local_id}) in {self.target_site}({self.site_id})"
\ No newline at end of file
+        return f"{self.uid}({self.local_id}) in {self.target_site}({self.site_id})"
+
+
+class TootStatusEnum(models.TextChoices):
+    PENDING = 'pending', _('待发布')
+    PUBLISHED = 'published', _('已发布')
+    FAILED = 'failed', _('发布失败')
+
+
+class Toot(models.Model):
+    """
+    Outbox of toots, published by `toot_publisher` out of the request.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='toots')
+    site = models.CharField(_("site domain name"), max_length=100)
+    content = models.TextField()
+    visibility = models.CharField(max_length=20)
+    # cleared once the toot is published or given up
+    token = models.CharField(max_length=100, blank=True, default='')
+    # sent with every attempt so that Mastodon won't post it twice
+    idempotency_key = models.CharField(max_length=64, unique=True)
+
+    status = models.CharField(
+        max_length=20, choices=TootStatusEnum.choices, default=TootStatusEnum.PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+    next_attempt_time = models.DateTimeField(default=timezone.now)
+
+    created_time = models.DateTimeField(auto_now_add=True)
+    published_time = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_time'], name='toot_outbox_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user}@{self.site} {self.status}({self.attempts})"
@@ -4,7 +4,7 @@ from django.utils.translation import ugettext_lazy as _
 from django.db import models
 from django.core.serializers.json import DjangoJSONEncoder
 from django.shortcuts import reverse
-from common.models import Entity, Mark, Review, Tag
+from common.models import Entity, Mark, Review, Tag, TagFrequency
 from common.utils import ChoicesDictGenerator, GenerateDateUUIDMediaFilePath
 from boofilsic.settings import MOVIE_MEDIA_PATH_ROOT, DEFAULT_MOVIE_IMAGE
 from django.utils import timezone
@@ -157,6 +157,7 @@ class Movie(Entity):
     ############################################
     is_series = models.BooleanField(default=False)
 
+    search_fields = ['title', 'orig_title', 'other_title']
 
     def __str__(self):
         if self.year:
@@ -171,6 +172,9 @@ class Movie(Entity):
     def get_tags_manager(self):
         return self.movie_tags
 
+    def get_tag_frequencies_manager(self):
+        return self.movie_tag_frequencies
+
 
     def get_genre_display(self):
         translated_genre = []
@@ -211,3 +215,15 @@ class MovieTag(Tag):
             models.UniqueConstraint(
                 fields=['content', 'mark'], name="unique_moviemark_tag")
         ]
+
+
+class MovieTagFrequency(TagFrequency):
+    movie = models.ForeignKey(Movie, on_delete=models.CASCADE, related_name='movie_tag_frequencies')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['movie', 'content'], name="unique_movie_tag_frequency")
+        ]
+        indexes = [
+            models.Index(fields=['movie', '-frequency'], name='movie_tag_frequency_idx'),
+        ]
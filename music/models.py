@@ -4,7 +4,7 @@ from django.utils.translation import ugettext_lazy as _
 from django.db import models
 from django.core.serializers.json import DjangoJSONEncoder
 from django.shortcuts import reverse
-from common.models import Entity, Mark, Review, Tag
+from common.models import Entity, Mark, Review, Tag, TagFrequency
 from common.utils import ChoicesDictGenerator, GenerateDateUUIDMediaFilePath
 from boofilsic.settings import SONG_MEDIA_PATH_ROOT, DEFAULT_SONG_IMAGE, ALBUM_MEDIA_PATH_ROOT, DEFAULT_ALBUM_IMAGE
 from django.utils import timezone
@@ -45,15 +45,48 @@ class Album(Entity):
     )
     track_list = models.TextField(_("曲目"), blank=True, default="")
 
+    search_fields = ['title', 'artist']
+
+    # title saved in db, songs are only refreshed when it changes, see `save`
+    _saved_title = None
+
     def __str__(self):
         return self.title
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        album = super().from_db(db, field_names, values)
+        album._saved_title = dict(zip(field_names, values)).get('title')
+        return album
+
+    def save(self, *args, **kwargs):
+        is_adding = self._state.adding
+        update_fields = kwargs.get('update_fields')
+        super().save(*args, **kwargs)
+        if update_fields is not None and 'title' not in update_fields:
+            return
+        # songs' search text contains the title of their album
+        if not is_adding and self.title != self._saved_title:
+            songs = []
+            for song in self.album_songs.only('id', 'title', 'artist', 'search_text', 'album'):
+                song.album = self
+                search_text = song.get_search_text()
+                if song.search_text != search_text:
+                    song.search_text = search_text
+                    songs.append(song)
+            if songs:
+                Song.objects.bulk_update(songs, ['search_text'])
+        self._saved_title = self.title
+
     def get_absolute_url(self):
         return reverse("music:retrieve_album", args=[self.id])
 
     def get_tags_manager(self):
         return self.album_tags
 
+    def get_tag_frequencies_manager(self):
+        return self.album_tag_frequencies
+
     @property
     def verbose_category_name(self):
         return _("专辑")
@@ -84,14 +117,26 @@ class Song(Entity):
     album = models.ForeignKey(
         Album, models.SET_NULL, "album_songs", null=True, blank=True, verbose_name=_("所属专辑"))
 
+    search_fields = ['title', 'artist']
+
     def __str__(self):
         return self.title
 
+    def get_search_text(self):
+        """ songs are also searchable by the title of their album """
+        search_text = super().get_search_text()
+        if self.album:
+            search_text += ' ' + self.album.title.lower()
+        return search_text
+
     def get_absolute_url(self):
         return reverse("music:retrieve_song", args=[self.id])
 
     def get_tags_manager(self):
         return self.song_tags
+
+    def get_tag_frequencies_manager(self):
+        return self.song_tag_frequencies
     
     @property
     def verbose_category_name(self):
@@ -165,3 +210,31 @@ class AlbumTag(Tag):
             models.UniqueConstraint(
                 fields=['content', 'mark'], name="unique_albummark_tag")
         ]
+
+
+class SongTagFrequency(TagFrequency):
+    song = models.ForeignKey(
+        Song, on_delete=models.CASCADE, related_name='song_tag_frequencies')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['song', 'content'], name="unique_song_tag_frequency")
+        ]
+        indexes = [
+            models.Index(fields=['song', '-frequency'], name='song_tag_frequency_idx'),
+        ]
+
+
+class AlbumTagFrequency(TagFrequency):
+    album = models.ForeignKey(
+        Album, on_delete=models.CASCADE, related_name='album_tag_frequencies')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['album', 'content'], name="unique_album_tag_frequency")
+        ]
+        indexes = [
+            models.Index(fields=['album', '-frequency'], name='album_tag_frequency_idx'),
+        ]
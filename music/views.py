@@ -1,15 +1,15 @@
 # from boofilsic.settings import MASTODON_TAGS
 from .forms import *
 from .models import *
-from common.models import SourceSiteEnum
+from common.models import SourceSiteEnum, UserMarkStats
 from common.views import PAGE_LINK_NUMBER, jump_or_scrape
 from common.utils import PageLinksGenerator
 from mastodon.utils import rating_to_emoji
-from mastodon.api import check_visibility, post_toot, TootVisibilityEnum
+from mastodon.api import check_visibility, TootVisibilityEnum
+from mastodon.jobs import enqueue_toot
 from mastodon import mastodon_request_included
 from django.core.paginator import Paginator
 from django.utils import timezone
-from django.db.models import Count
 from django.db import IntegrityError, transaction
 from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
 from django.http import HttpResponseBadRequest, HttpResponseServerError
@@ -22,7 +22,6 @@ from django.shortcuts import render
 
 
 logger = logging.getLogger(__name__)
-mastodon_logger = logging.getLogger("django.mastodon")
 
 
 # how many marks showed on the detail page
@@ -169,8 +168,7 @@ def retrieve_song(request, id):
             
 
         # retrieve tags
-        song_tag_list = song.song_tags.values('content').annotate(
-            tag_frequency=Count('content')).order_by('-tag_frequency')[:TAG_NUMBER]
+        song_tag_list = song.get_tag_list(TAG_NUMBER)
 
         # retrieve user mark and initialize mark form
         try:
@@ -206,10 +204,11 @@ def retrieve_song(request, id):
             mark_list_more = None
             review_list_more = None
         else:
+            # fetch one more item to tell if there are more
             mark_list = SongMark.get_available(
-                song, request.user, request.session['oauth_token'])
+                song, request.user, request.session['oauth_token'], MARK_NUMBER + 1)
             review_list = SongReview.get_available(
-                song, request.user, request.session['oauth_token'])
+                song, request.user, request.session['oauth_token'], REVIEW_NUMBER + 1)
             mark_list_more = True if len(mark_list) > MARK_NUMBER else False
             mark_list = mark_list[:MARK_NUMBER]
             for m in mark_list:
@@ -264,7 +263,9 @@ def delete_song(request, id):
         if request.user.is_staff:
             # only staff has right to delete
             song = get_object_or_404(Song, pk=id)
-            song.delete()
+            with transaction.atomic():
+                UserMarkStats.remove_marks(song.song_marks.all())
+                song.delete()
             return redirect(reverse("common:home"))
         else:
             raise PermissionDenied()
@@ -285,11 +286,13 @@ def create_update_song_mark(request):
         pk = request.POST.get('id')
         old_rating = None
         old_tags = None
+        old_stats_key = None
         if pk:
             mark = get_object_or_404(SongMark, pk=pk)
             if request.user != mark.owner:
                 return HttpResponseBadRequest()
             old_rating = mark.rating
+            old_stats_key = mark.get_stats_key()
             old_tags = mark.songmark_tags.all()
             # update
             form = SongMarkForm(request.POST, instance=mark)
@@ -310,6 +313,12 @@ def create_update_song_mark(request):
                     # update song rating
                     song.update_rating(old_rating, form.instance.rating)
                     form.save()
+                    UserMarkStats.update_stats(old_stats_key, form.instance.get_stats_key())
+                    # update tag frequencies before old tags are deleted
+                    song.update_tag_frequencies(
+                        [tag.content for tag in old_tags] if old_tags else None,
+                        form.cleaned_data['tags']
+                    )
                     # update tags
                     if old_tags:
                         for tag in old_tags:
@@ -340,12 +349,7 @@ def create_update_song_mark(request):
                 tags = ''
                 content = words + '\n' + url + '\n' + \
                     form.cleaned_data['text'] + '\n' + tags
-                response = post_toot(request.user.mastodon_site, content, visibility,
-                                     request.session['oauth_token'])
-                if response.status_code != 200:
-                    mastodon_logger.error(
-                        f"CODE:{response.status_code} {response.text}")
-                    return HttpResponseServerError("publishing mastodon status failed")
+                enqueue_toot(request.user, content, visibility, request.session['oauth_token'])
         else:
             return HttpResponseBadRequest("invalid form data")
 
@@ -391,6 +395,9 @@ def delete_song_mark(request, id):
             with transaction.atomic():
                 # update song rating
                 mark.song.update_rating(mark.rating, None)
+                mark.song.update_tag_frequencies(
+                    [tag.content for tag in mark.songmark_tags.all()], None)
+                UserMarkStats.update_stats(mark.get_stats_key(), None)
                 mark.delete()
         except IntegrityError as e:
             return HttpResponseServerError()
@@ -432,12 +439,7 @@ def create_song_review(request, song_id):
                 tags = ''
                 content = words + '\n' + url + \
                     '\n' + form.cleaned_data['title'] + '\n' + tags
-                response = post_toot(request.user.mastodon_site, content, visibility,
-                                     request.session['oauth_token'])
-                if response.status_code != 200:
-                    mastodon_logger.error(
-                        f"CODE:{response.status_code} {response.text}")
-                    return HttpResponseServerError("publishing mastodon status failed")
+                enqueue_toot(request.user, content, visibility, request.session['oauth_token'])
             return redirect(reverse("music:retrieve_song_review", args=[form.instance.id]))
         else:
             return HttpResponseBadRequest()
@@ -484,12 +486,7 @@ def update_song_review(request, id):
                 tags = ''
                 content = words + '\n' + url + \
                     '\n' + form.cleaned_data['title'] + '\n' + tags
-                response = post_toot(request.user.mastodon_site, content, visibility,
-                                     request.session['oauth_token'])
-                if response.status_code != 200:
-                    mastodon_logger.error(
-                        f"CODE:{response.status_code} {response.text}")
-                    return HttpResponseServerError("publishing mastodon status failed")
+                enqueue_toot(request.user, content, visibility, request.session['oauth_token'])
             return redirect(reverse("music:retrieve_song_review", args=[form.instance.id]))
         else:
             return HttpResponseBadRequest()
@@ -740,8 +737,7 @@ def retrieve_album(request, id):
         album.get_duration_display = ms_to_readable(album.duration)
 
         # retrieve tags
-        album_tag_list = album.album_tags.values('content').annotate(
-            tag_frequency=Count('content')).order_by('-tag_frequency')[:TAG_NUMBER]
+        album_tag_list = album.get_tag_list(TAG_NUMBER)
 
         # retrieve user mark and initialize mark form
         try:
@@ -777,10 +773,11 @@ def retrieve_album(request, id):
             mark_list_more = None
             review_list_more = None
         else:
+            # fetch one more item to tell if there are more
             mark_list = AlbumMark.get_available(
-                album, request.user, request.session['oauth_token'])
+                album, request.user, request.session['oauth_token'], MARK_NUMBER + 1)
             review_list = AlbumReview.get_available(
-                album, request.user, request.session['oauth_token'])
+                album, request.user, request.session['oauth_token'], REVIEW_NUMBER + 1)
             mark_list_more = True if len(mark_list) > MARK_NUMBER else False
             mark_list = mark_list[:MARK_NUMBER]
             for m in mark_list:
@@ -835,7 +832,9 @@ def delete_album(request, id):
         if request.user.is_staff:
             # only staff has right to delete
             album = get_object_or_404(Album, pk=id)
-            album.delete()
+            with transaction.atomic():
+                UserMarkStats.remove_marks(album.album_marks.all())
+                album.delete()
             return redirect(reverse("common:home"))
         else:
             raise PermissionDenied()
@@ -856,11 +855,13 @@ def create_update_album_mark(request):
         pk = request.POST.get('id')
         old_rating = None
         old_tags = None
+        old_stats_key = None
         if pk:
             mark = get_object_or_404(AlbumMark, pk=pk)
             if request.user != mark.owner:
                 return HttpResponseBadRequest()
             old_rating = mark.rating
+            old_stats_key = mark.get_stats_key()
             old_tags = mark.albummark_tags.all()
             # update
             form = AlbumMarkForm(request.POST, instance=mark)
@@ -881,6 +882,12 @@ def create_update_album_mark(request):
                     # update album rating
                     album.update_rating(old_rating, form.instance.rating)
                     form.save()
+                    UserMarkStats.update_stats(old_stats_key, form.instance.get_stats_key())
+                    # update tag frequencies before old tags are deleted
+                    album.update_tag_frequencies(
+                        [tag.content for tag in old_tags] if old_tags else None,
+                        form.cleaned_data['tags']
+                    )
                     # update tags
                     if old_tags:
                         for tag in old_tags:
@@ -911,12 +918,7 @@ def create_update_album_mark(request):
                 tags = ''
                 content = words + '\n' + url + '\n' + \
                     form.cleaned_data['text'] + '\n' + tags
-                response = post_toot(request.user.mastodon_site, content, visibility,
-                                     request.session['oauth_token'])
-                if response.status_code != 200:
-                    mastodon_logger.error(
-                        f"CODE:{response.status_code} {response.text}")
-                    return HttpResponseServerError("publishing mastodon status failed")
+                enqueue_toot(request.user, content, visibility, request.session['oauth_token'])
         else:
             return HttpResponseBadRequest("invalid form data")
 
@@ -962,6 +964,9 @@ def delete_album_mark(request, id):
             with transaction.atomic():
                 # update album rating
                 mark.album.update_rating(mark.rating, None)
+                mark.album.update_tag_frequencies(
+                    [tag.content for tag in mark.albummark_tags.all()], None)
+                UserMarkStats.update_stats(mark.get_stats_key(), None)
                 mark.delete()
         except IntegrityError as e:
             return HttpResponseServerError()
@@ -1003,12 +1008,7 @@ def create_album_review(request, album_id):
                 tags = ''
                 content = words + '\n' + url + \
                     '\n' + form.cleaned_data['title'] + '\n' + tags
-                response = post_toot(request.user.mastodon_site, content, visibility,
-                                     request.session['oauth_token'])
-                if response.status_code != 200:
-                    mastodon_logger.error(
-                        f"CODE:{response.status_code} {response.text}")
-                    return HttpResponseServerError("publishing mastodon status failed")
+                enqueue_toot(request.user, content, visibility, request.session['oauth_token'])
             return redirect(reverse("music:retrieve_album_review", args=[form.instance.id]))
         else:
             return HttpResponseBadRequest()
@@ -1055,12 +1055,7 @@ def update_album_review(request, id):
                 tags = ''
                 content = words + '\n' + url + \
                     '\n' + form.cleaned_data['title'] + '\n' + tags
-                response = post_toot(request.user.mastodon_site, content, visibility,
-                                     request.session['oauth_token'])
-                if response.status_code != 200:
-                    mastodon_logger.error(
-                        f"CODE:{response.status_code} {response.text}")
-                    return HttpResponseServerError("publishing mastodon status failed")
+                enqueue_toot(request.user, content, visibility, request.session['oauth_token'])
             return redirect(reverse("music:retrieve_album_review", args=[form.instance.id]))
         else:
             return HttpResponseBadRequest()
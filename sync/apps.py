@@ -1,9 +1,13 @@
 from django.apps import AppConfig
+from common.utils import is_server_process
 
 
 class SyncConfig(AppConfig):
     name = 'sync'
 
     def ready(self):
-        from sync.jobs import sync_task_manager
-        sync_task_manager.start()
\ No newline at end of file
+        # workers and their signal handlers are only for processes serving
+        # requests, which add sync tasks
+        if is_server_process():
+            from sync.jobs import sync_task_manager
+            sync_task_manager.start()
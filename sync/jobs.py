@@ -1,12 +1,19 @@
+import atexit
+import itertools
 import logging
+import os
 import pytz
 import signal
+import socket
 import sys
-import queue
 import threading
 import time
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timedelta
+from django.db import transaction, close_old_connections
+from django.db.models import Q, F
 from django.utils import timezone
 from django.core.exceptions import ObjectDoesNotExist
 from openpyxl import load_workbook
@@ -15,7 +22,10 @@ from movies.models import MovieMark, Movie, MovieTag
 from music.models import AlbumMark, Album, AlbumTag
 from games.models import GameMark, Game, GameTag
 from common.scraper import DoubanAlbumScraper, DoubanBookScraper, DoubanGameScraper, DoubanMovieScraper
-from common.models import MarkStatusEnum
+from common.models import MarkStatusEnum, UserMarkStats
+from boofilsic.settings import SYNC_SCRAPE_WORKERS, SYNC_SCRAPE_CONCURRENCY_PER_HOST
+from boofilsic.settings import SYNC_WORKERS, SYNC_TIME_SLICE, SYNC_LEASE_TIME, SYNC_DRAIN_TIMEOUT
+from boofilsic.settings import SYNC_FLUSH_ROWS, SYNC_FLUSH_INTERVAL
 from .models import SyncTask
 
 __all__ = ['sync_task_manager']
@@ -23,64 +33,146 @@ __all__ = ['sync_task_manager']
 logger = logging.getLogger(__name__)
 
 
-class SyncTaskManger:
+class SyncTaskManager:
+    """
+    Run sync tasks with a fixed number of worker threads. Tasks are queued
+    in the db and leased by workers, so unfinished tasks are picked up again
+    after restart, and by any process running the manager. Each lease lasts
+    for a time slice, after which the task goes back to the queue, so that
+    large imports don't block tasks of other users.
+    """
 
     # in seconds
-    __CHECK_NEW_TASK_TIME_INTERVAL = 0.05
-    MAX_WORKERS = 256
+    CHECK_NEW_TASK_TIME_INTERVAL = 5
 
     def __init__(self):
-        self.__task_queue = queue.Queue(0)
         self.__stop_event = threading.Event()
+        self.__new_task_event = threading.Event()
         self.__worker_threads = []
-
-    def __listen_for_new_task(self):
-        while not self.__stop_event.is_set():
-            time.sleep(self.__CHECK_NEW_TASK_TIME_INTERVAL)
-            while not self.__task_queue.empty() and not self.is_full():
-                task = self.__task_queue.get_nowait()
-                self.__start_new_worker(task)
-
-    def __start_new_worker(self, task):
-        new_worker = threading.Thread(
-            target=sync_doufen_job, args=[task, self.is_stopped], daemon=True
-        )
-        self.__worker_threads.append(new_worker)
-        new_worker.start()
-
-    def __enqueue_existing_tasks(self):
-        for task in SyncTask.objects.filter(is_finished=False):
-            self.__task_queue.put_nowait(task)
-
-    def is_full(self):
-        return len(self.__worker_threads) >= self.MAX_WORKERS
+        self.__previous_signal_handlers = {}
+
+    def __claim_task(self, lease_owner):
+        now = timezone.now()
+        with transaction.atomic():
+            task = SyncTask.objects.select_for_update(skip_locked=True).filter(
+                Q(leased_until__isnull=True) | Q(leased_until__lt=now),
+                is_finished=False,
+            ).order_by(F('last_run_time').asc(nulls_first=True), 'id').first()
+            if task is not None:
+                task.lease_owner = lease_owner
+                task.leased_until = now + timedelta(seconds=SYNC_LEASE_TIME)
+                task.save(update_fields=['lease_owner', 'leased_until'])
+        return task
+
+    def __release_task(self, task, lease_owner):
+        SyncTask.objects.filter(pk=task.pk, lease_owner=lease_owner).update(
+            lease_owner='', leased_until=None, last_run_time=timezone.now())
+
+    def __get_stop_check_func(self, task, lease_owner):
+        lease_renew_time = time.monotonic() + SYNC_LEASE_TIME / 2
+
+        def stop_check_func():
+            nonlocal lease_renew_time
+            if self.is_stopped():
+                return True
+            if time.monotonic() > lease_renew_time:
+                # stop if the lease has been taken over
+                if not SyncTask.objects.filter(pk=task.pk, lease_owner=lease_owner).update(
+                        leased_until=timezone.now() + timedelta(seconds=SYNC_LEASE_TIME)):
+                    return True
+                lease_renew_time = time.monotonic() + SYNC_LEASE_TIME / 2
+            return False
+
+        return stop_check_func
+
+    def __work(self, lease_owner):
+        while not self.is_stopped():
+            try:
+                task = self.__claim_task(lease_owner)
+                if task is not None:
+                    try:
+                        sync_doufen_job(
+                            task,
+                            self.__get_stop_check_func(task, lease_owner),
+                            time.monotonic() + SYNC_TIME_SLICE,
+                        )
+                    except Exception as e:
+                        logger.error(f"sync task {task.pk} failed", exc_info=e)
+                        SyncTask.objects.filter(pk=task.pk).update(
+                            is_failed=True, is_finished=True)
+                    finally:
+                        self.__release_task(task, lease_owner)
+            except Exception as e:
+                logger.error("error when claiming sync task", exc_info=e)
+                task = None
+            finally:
+                close_old_connections()
+            if task is None:
+                self.__new_task_event.wait(self.CHECK_NEW_TASK_TIME_INTERVAL)
+                self.__new_task_event.clear()
+
+    def __handle_signal(self, signum, frame):
+        # only ask workers to stop, they are waited for at exit, so that the
+        # server keeps handling its shutdown meanwhile
+        logger.info(f'received signal {signum}, stopping sync tasks')
+        self.stop()
+
+        # chain to the handler set before
+        previous_handler = self.__previous_signal_handlers.get(signum)
+        if callable(previous_handler):
+            previous_handler(signum, frame)
+        elif previous_handler == signal.SIG_DFL:
+            # exit normally instead of being killed, so that workers are drained
+            sys.exit(128 + signum)
+
+    def __drain(self):
+        self.stop()
+        self.join(SYNC_DRAIN_TIMEOUT)
+        logger.info('sync tasks drained')
+
+    def __register_signal_handlers(self):
+        # handlers can only be set in the main thread
+        if threading.current_thread() is not threading.main_thread():
+            return
+        signums = [signal.SIGTERM, signal.SIGINT]
+        if sys.platform.startswith('linux'):
+            signums.append(signal.SIGHUP)
+        for signum in signums:
+            self.__previous_signal_handlers[signum] = signal.signal(
+                signum, self.__handle_signal)
 
     def add_task(self, task):
-        self.__task_queue.put_nowait(task)
-
-    def stop(self, signum, frame):
-        print('rceived signal ', signum)
-        logger.info(f'rceived signal {signum}')
+        """
+        The task is already saved in the db, just wake up an idle worker.
+        """
+        self.__new_task_event.set()
 
+    def stop(self):
         self.__stop_event.set()
-        # for worker_thread in self.__worker_threads:
-        #     worker_thread.join()
+        self.__new_task_event.set()
 
-        print("stopped")
-        logger.info(f'stopped')
+    def join(self, timeout=None):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for worker_thread in self.__worker_threads:
+            worker_thread.join(
+                None if deadline is None else max(deadline - time.monotonic(), 0))
 
     def is_stopped(self):
         return self.__stop_event.is_set()
 
     def start(self):
-        self.__enqueue_existing_tasks()  # enqueue
-
-        listen_new_task_thread = threading.Thread(
-            target=self.__listen_for_new_task, daemon=True)
-
-        self.__worker_threads.append(listen_new_task_thread)
-
-        listen_new_task_thread.start()
+        """
+        Start workers in this process, which should be a server process, since
+        signal handlers are installed to drain workers on shutdown.
+        """
+        self.__register_signal_handlers()
+        atexit.register(self.__drain)
+        lease_owner_prefix = f"{socket.gethostname()}:{os.getpid()}"
+        for i in range(SYNC_WORKERS):
+            worker_thread = threading.Thread(
+                target=self.__work, args=[f"{lease_owner_prefix}:{i}"], daemon=True)
+            self.__worker_threads.append(worker_thread)
+            worker_thread.start()
 
 
 class DoufenParser:
@@ -100,9 +192,9 @@ class DoufenParser:
             self.__is_new_task = False
         if self.__progress_row is None:
             self.__progress_row = 2
-        # data in the excel parse in python types
         self.task = task
-        self.items = []
+        self.__fp = None
+        self.__wb = None
 
     def __open_file(self):
         self.__fp = open(self.__file_path, 'rb')
@@ -116,7 +208,10 @@ class DoufenParser:
     def __close_file(self):
         if self.__wb is not None:
             self.__wb.close()
-        self.__fp.close()
+            self.__wb = None
+        if self.__fp is not None:
+            self.__fp.close()
+            self.__fp = None
 
     def __get_item_classes_mapping(self):
         '''
@@ -153,10 +248,8 @@ class DoufenParser:
     def __parse_items(self):
         assert self.__wb is not None, 'workbook not found'
 
-        item_classes_mappings = self.__get_item_classes_mapping()
-
         is_first_sheet = True
-        for mapping in item_classes_mappings:
+        for mapping in self.__mappings:
             ws = self.__wb[mapping['sheet']]
 
             # empty sheet
@@ -167,16 +260,19 @@ class DoufenParser:
             start_row_index = 2
             if not self.__is_new_task and is_first_sheet:
                 start_row_index = self.__progress_row
+            # set first sheet flag
+            is_first_sheet = False
 
             # parse data
-            for i in range(start_row_index, ws.max_row + 1):
+            rows = ws.iter_rows(min_row=start_row_index, values_only=True)
+            for i, row in enumerate(rows, start=start_row_index):
                 # url definitely exists
-                url = ws.cell(row=i, column=self.URL_INDEX).value
+                url = row[self.URL_INDEX - 1]
 
-                tags = ws.cell(row=i, column=self.TAG_INDEX).value
+                tags = row[self.TAG_INDEX - 1]
                 tags = tags.split(',') if tags else None
 
-                time = ws.cell(row=i, column=self.TIME_INDEX).value
+                time = row[self.TIME_INDEX - 1]
                 if time:
                     time = datetime.strptime(time, "%Y-%m-%d %H:%M:%S")
                     tz = pytz.timezone('Asia/Shanghai')
@@ -184,15 +280,14 @@ class DoufenParser:
                 else:
                     time = None
 
-                content = ws.cell(row=i, column=self.CONTENT_INDEX).value
+                content = row[self.CONTENT_INDEX - 1]
                 if not content:
                     content = ""
 
-                rating = ws.cell(row=i, column=self.RATING_INDEX).value
+                rating = row[self.RATING_INDEX - 1]
                 rating = int(rating) * 2 if rating else None
 
-                # store result
-                self.items.append({
+                yield {
                     'data': DoufenRowData(url, tags, time, content, rating),
                     'entity_class': mapping['entity_class'],
                     'mark_class': mapping['mark_class'],
@@ -200,10 +295,7 @@ class DoufenParser:
                     'scraper': mapping['scraper'],
                     'sheet': mapping['sheet'],
                     'row_index': i,
-                })
-
-            # set first sheet flag
-            is_first_sheet = False
+                }
 
     def __get_item_number(self):
         assert not self.__wb is None, 'workbook not found'
@@ -222,13 +314,16 @@ class DoufenParser:
         self.task.save(update_fields=["total_items"])
 
     def parse(self):
+        """
+        Generate items row by row, the file is kept open until the generator
+        is exhausted or closed.
+        """
         try:
             self.__open_file()
-            self.__parse_items()
+            self.__get_item_classes_mapping()
             if self.__is_new_task:
                 self.__update_total_items()
-            self.__close_file()
-            return self.items
+            yield from self.__parse_items()
 
         except Exception as e:
             logger.error(e)
@@ -247,56 +342,318 @@ class DoufenRowData:
     rating: int
 
 
-def add_new_mark(data, user, entity, entity_class, mark_class, tag_class, sheet, is_private):
-    params = {
-        'owner': user,
-        'created_time': data.time,
-        'edited_time': data.time,
-        'rating': data.rating,
-        'text': data.content,
-        'status': translate_status(sheet),
-        'is_private': not is_private,
-        entity_class.__name__.lower(): entity,
-    }
-    mark = mark_class.objects.create(**params)
-    entity.update_rating(None, data.rating)
-    if data.tags:
-        for tag in data.tags:
-            params = {
-                'content': tag,
-                entity_class.__name__.lower(): entity,
-                'mark': mark
-            }
-            tag_class.objects.create(**params)
-
-
-def overwrite_mark(entity, entity_class, mark, mark_class, tag_class, data, sheet):
-    old_rating = mark.rating
-    old_tags = getattr(mark, mark_class.__name__.lower()+'_tags').all()
-    # update mark logic
-    mark.created_time = data.time
-    mark.edited_time = data.time
-    mark.text = data.content
-    mark.rating = data.rating
-    mark.status = translate_status(sheet)
-    mark.save()
-    entity.update_rating(old_rating, data.rating)
-    if old_tags:
-        for tag in old_tags:
-            tag.delete()
-    if data.tags:
-        for tag in data.tags:
-            params = {
-                'content': tag,
-                entity_class.__name__.lower(): entity,
-                'mark': mark
+@dataclass
+class ImportRow:
+    item: dict
+    entity: object
+    # existing mark to be overwritten, None if to be created
+    mark: object
+    # stats key of the existing mark before it's overwritten
+    old_stats_key: tuple = None
+
+
+class MarkImportWriter:
+    """
+    Collect marks of synced rows and write them in bulk, with one INSERT
+    or UPDATE for each kind of writes of each mark class.
+    """
+
+    def __init__(self, task):
+        self.task = task
+        # in form of {(mark_class, entity_id): row}
+        self.__rows = {}
+        # marks created by this writer, in form of {(mark_class, entity_id): mark},
+        # since marks of rows are resolved before previous rows are written
+        self.__created_marks = {}
+
+    def add(self, item, entity, mark):
+        key = (item['mark_class'], entity.pk)
+        if mark is None:
+            mark = self.__created_marks.get(key)
+        pending_row = self.__rows.get(key)
+        if pending_row is not None:
+            mark = pending_row.mark
+        if (pending_row is not None or mark is not None) and not self.task.overwrite:
+            # same entity in multiple rows, the mark is already there
+            return
+        # taken before writing, since a failed batch may have changed the mark
+        old_stats_key = mark.get_stats_key() if mark is not None else None
+        self.__rows[key] = ImportRow(item, entity, mark, old_stats_key)
+
+    def clear(self):
+        """
+        Drop collected rows without writing them.
+        """
+        self.__rows = {}
+
+    def flush(self):
+        """
+        Write collected rows and return urls of rows failed to be written.
+        If the batch fails, rows are written again one by one.
+        """
+        rows = list(self.__rows.values())
+        self.__rows = {}
+        if not rows:
+            return []
+        try:
+            with transaction.atomic():
+                created_marks = self.__write(rows)
+            self.__created_marks.update(created_marks)
+            return []
+        except Exception as e:
+            logger.error(
+                "Exception when syncing marks in bulk, retry one by one", exc_info=e)
+
+        failed_urls = []
+        for row in rows:
+            try:
+                with transaction.atomic():
+                    created_marks = self.__write([row])
+                self.__created_marks.update(created_marks)
+            except Exception as e:
+                logger.error(
+                    "Unknown exception when syncing marks", exc_info=e)
+                failed_urls.append(row.item['data'].url)
+        return failed_urls
+
+    def __write(self, rows):
+        created_marks = {}
+        stats_deltas = Counter()
+        rows_by_mark_class = {}
+        for row in rows:
+            rows_by_mark_class.setdefault(row.item['mark_class'], []).append(row)
+
+        for mark_class, class_rows in rows_by_mark_class.items():
+            entity_class = class_rows[0].item['entity_class']
+            tag_class = class_rows[0].item['tag_class']
+            entity_field = entity_class.__name__.lower()
+
+            new_marks = []
+            overwritten_marks = []
+            marked_rows = []
+            for row in class_rows:
+                data = row.item['data']
+                if row.mark is None:
+                    mark = mark_class(**{
+                        'owner': self.task.user,
+                        'is_private': not self.task.default_public,
+                        entity_field: row.entity,
+                    })
+                    new_marks.append(mark)
+                else:
+                    mark = row.mark
+                    overwritten_marks.append(mark)
+                mark.created_time = data.time
+                mark.edited_time = data.time
+                mark.rating = data.rating
+                mark.text = data.content
+                mark.status = translate_status(row.item['sheet'])
+                marked_rows.append((row, mark))
+                if row.old_stats_key is not None:
+                    stats_deltas[row.old_stats_key] -= 1
+                stats_deltas[mark.get_stats_key()] += 1
+
+            mark_class.objects.bulk_create(new_marks)
+            for mark in new_marks:
+                created_marks[(mark_class, getattr(mark, entity_field + '_id'))] = mark
+            mark_class.objects.bulk_update(
+                overwritten_marks, ['created_time', 'edited_time', 'rating', 'text', 'status'])
+
+            tag_frequency_deltas = Counter()
+            old_tags = tag_class.objects.filter(mark__in=overwritten_marks)
+            for entity_id, content in old_tags.values_list('mark__' + entity_field, 'content'):
+                tag_frequency_deltas[(entity_id, content)] -= 1
+            old_tags.delete()
+
+            new_tags = []
+            for row, mark in marked_rows:
+                for content in dict.fromkeys(row.item['data'].tags or []):
+                    new_tags.append(tag_class(**{
+                        'content': content,
+                        entity_field: row.entity,
+                        'mark': mark,
+                    }))
+                    tag_frequency_deltas[(row.entity.pk, content)] += 1
+            tag_class.objects.bulk_create(new_tags)
+
+            entity_ids = sorted({row.entity.pk for row in class_rows})
+            entity_class.recalculate_ratings(entity_ids)
+            entity_class.apply_tag_frequency_deltas(tag_frequency_deltas)
+        UserMarkStats.apply_deltas(stats_deltas)
+        return created_marks
+
+
+# limit concurrent scrapings of each host actually requested, e.g. scraperapi
+# for douban, shared by all sync tasks
+scrape_semaphores = {}
+scrape_semaphores_lock = threading.Lock()
+
+
+def scrape_with_host_limit(scraper, url):
+    host = scraper.get_request_host(url)
+    with scrape_semaphores_lock:
+        if host not in scrape_semaphores:
+            scrape_semaphores[host] = threading.BoundedSemaphore(
+                SYNC_SCRAPE_CONCURRENCY_PER_HOST)
+        semaphore = scrape_semaphores[host]
+    with semaphore:
+        return scraper.scrape(url)
+
+
+class ScrapePipeline:
+    """
+    Scrape entities of upcoming rows concurrently while rows are handled
+    in order. Only the scraping runs in worker threads, entities are saved
+    by the consumer, which checks the db again before saving.
+
+    Rows are read in chunks, existing entities and marks of each chunk are
+    fetched in bulk and set to items as `entity` and `mark`, None if missing.
+    """
+
+    # how many rows ahead of the current one are scraped
+    LOOKAHEAD = SYNC_SCRAPE_WORKERS * 4
+    # how many rows are resolved at once
+    CHUNK_SIZE = SYNC_SCRAPE_WORKERS * 2
+
+    def __init__(self, items, user):
+        self.__items = iter(items)
+        self.__user = user
+        self.__pending = deque()
+        # in form of {url: future}, so that duplicated urls are scraped once
+        self.__futures = {}
+        self.__executor = ThreadPoolExecutor(max_workers=SYNC_SCRAPE_WORKERS)
+
+    def __resolve(self, chunk):
+        items_by_class = {}
+        for item in chunk:
+            items_by_class.setdefault(
+                (item['entity_class'], item['mark_class']), []).append(item)
+
+        for (entity_class, mark_class), class_items in items_by_class.items():
+            entity_field = entity_class.__name__.lower()
+            entities = {
+                entity.source_url: entity for entity in entity_class.objects.filter(
+                    source_url__in={item['data'].url for item in class_items})
             }
-            tag_class.objects.create(**params)
+            marks = {
+                getattr(mark, entity_field + '_id'): mark for mark in mark_class.objects.filter(**{
+                    'owner': self.__user,
+                    entity_field + '__in': list(entities.values()),
+                })
+            } if entities else {}
+            for item in class_items:
+                entity = entities.get(item['data'].url)
+                item['entity'] = entity
+                item['mark'] = marks.get(entity.pk) if entity is not None else None
+
+    def __fill(self):
+        while len(self.__pending) <= self.LOOKAHEAD - self.CHUNK_SIZE:
+            chunk = list(itertools.islice(self.__items, self.CHUNK_SIZE))
+            if not chunk:
+                return
+            self.__resolve(chunk)
+            for item in chunk:
+                url = item['data'].url
+                if item['entity'] is None and url not in self.__futures:
+                    self.__futures[url] = self.__executor.submit(
+                        scrape_with_host_limit, item['scraper'], url)
+                self.__pending.append(item)
+
+    def __iter__(self):
+        self.__fill()
+        while self.__pending:
+            yield self.__pending.popleft()
+            self.__fill()
+
+    def get_scrape_result(self, url):
+        """
+        Block until the scraping of url is done, exceptions are re-raised.
+        """
+        future = self.__futures.pop(url, None)
+        if future is None:
+            # saved before scraping started, yet deleted since then
+            raise ObjectDoesNotExist(f"{url} was not scraped")
+        return future.result()
+
+    def stop_reading(self):
+        """
+        Stop reading new rows, rows already read are still iterated.
+        """
+        self.__items = iter(())
+
+    def close(self):
+        for future in self.__futures.values():
+            future.cancel()
+        self.__executor.shutdown(wait=False)
+
+
+class ProgressCheckpoint:
+    """
+    Accumulate progress and marks of a task in memory, and save them together
+    with the breakpoint in one transaction, every SYNC_FLUSH_ROWS rows or
+    SYNC_FLUSH_INTERVAL seconds. The breakpoint points to the row after the
+    last handled one.
+
+    Progress is only saved while the task is leased by the worker running it,
+    the lease owner is taken from the task when the job starts. Otherwise
+    the task has been taken over, and unsaved rows are left to the new owner.
+    """
+
+    def __init__(self, task):
+        self.task = task
+        self.writer = MarkImportWriter(task)
+        self.__unflushed_rows = 0
+        self.__last_flush_time = time.monotonic()
+
+    def handle_row(self, sheet, row_index, url, is_success):
+        """
+        Return False if the lease is found lost when flushing.
+        """
+        self.task.finished_items += 1
+        if is_success:
+            self.task.success_items += 1
+        else:
+            self.task.failed_urls.append(url)
+        self.task.set_breakpoint(sheet, row_index + 1)
+        self.__unflushed_rows += 1
+        if self.__unflushed_rows >= SYNC_FLUSH_ROWS or \
+                time.monotonic() - self.__last_flush_time >= SYNC_FLUSH_INTERVAL:
+            return self.flush()
+        return True
+
+    def flush(self):
+        """
+        Return False if the lease is lost, in which case nothing is saved.
+        """
+        is_leased = True
+        if self.__unflushed_rows > 0:
+            with transaction.atomic():
+                # the row is locked, so that the lease can't be taken over until saved
+                is_leased = SyncTask.objects.select_for_update().filter(
+                    pk=self.task.pk,
+                    lease_owner=self.task.lease_owner,
+                    leased_until__gt=timezone.now(),
+                ).exists()
+                if is_leased:
+                    for url in self.writer.flush():
+                        self.task.success_items -= 1
+                        self.task.failed_urls.append(url)
+                    self.task.save(update_fields=[
+                        'break_point', 'finished_items', 'success_items', 'failed_urls'])
+                else:
+                    logger.warning(f"sync task {self.task.pk} was taken over, progress dropped")
+                    self.writer.clear()
+        self.__unflushed_rows = 0
+        self.__last_flush_time = time.monotonic()
+        return is_leased
 
 
-def sync_doufen_job(task, stop_check_func):
+def sync_doufen_job(task, stop_check_func, time_slice_end):
     """
-    TODO: Update task status every certain amount of items to reduce IO consumption
+    Sync rows of the task until it finishes, or stop_check_func returns True,
+    or the time slice ends. At the end of the time slice, rows being scraped
+    are still handled, so that their scrapings are not redone next time.
+    If the lease is lost, progress since the last flush is dropped.
     """
     task = SyncTask.objects.get(pk=task.pk)
     if task.is_finished:
@@ -305,76 +662,71 @@ def sync_doufen_job(task, stop_check_func):
     parser = DoufenParser(task)
     items = parser.parse()
 
-    # use pop to reduce memo consumption
-    while len(items) > 0 and not stop_check_func():
-        item = items.pop(0)
-        data = item['data']
-        entity_class = item['entity_class']
-        mark_class = item['mark_class']
-        tag_class = item['tag_class']
-        scraper = item['scraper']
-        sheet = item['sheet']
-        row_index = item['row_index']
-
-        # update progress
-        task.set_breakpoint(sheet, row_index, save=True)
-
-        # scrape the entity if not exists
+    pipeline = ScrapePipeline(items, task.user)
+    progress = ProgressCheckpoint(task)
+    is_stopped = False
+    try:
+        for item in pipeline:
+            if stop_check_func():
+                is_stopped = True
+                break
+            if not is_stopped and time.monotonic() > time_slice_end:
+                is_stopped = True
+                pipeline.stop_reading()
+            is_success = sync_item(task, item, pipeline, progress.writer)
+            if not progress.handle_row(item['sheet'], item['row_index'], item['data'].url, is_success):
+                is_stopped = True
+                break
+    finally:
+        pipeline.close()
+        items.close()
+        is_leased = progress.flush()
+
+    # if task finish
+    if not is_stopped and is_leased:
+        task.is_finished = True
+        task.clear_breakpoint()
+        task.save(update_fields=['is_finished', 'break_point'])
+
+
+def sync_item(task, item, pipeline, writer):
+    """
+    Return whether the item is synced successfully, marks are added to
+    the writer, failures of which are reported when flushed.
+    """
+    data = item['data']
+    entity_class = item['entity_class']
+    mark_class = item['mark_class']
+    scraper = item['scraper']
+
+    entity = item['entity']
+    mark = item['mark']
+
+    # save the scraped entity if not exists
+    if entity is None:
         try:
+            # may be saved by an earlier row since resolved
             entity = entity_class.objects.get(source_url=data.url)
         except ObjectDoesNotExist:
             try:
-                scraper.scrape(data.url)
-                form = scraper.save(request_user=task.user)
+                result = pipeline.get_scrape_result(data.url)
+                form = scraper.save(result, request_user=task.user)
                 entity = form.instance
             except Exception as e:
                 logger.error(f"Scrape Failed URL: {data.url}")
                 logger.error(
                     "Expections during scraping data:", exc_info=e)
-                task.failed_urls.append(data.url)
-                task.finished_items += 1
-                task.save(update_fields=['failed_urls', 'finished_items'])
-                continue
-
-        # sync mark
-        try:
-            # already exists
-            params = {
+                return False
+        else:
+            # marks written by this task are tracked by the writer
+            mark = mark_class.objects.filter(**{
                 'owner': task.user,
-                entity_class.__name__.lower(): entity
-            }
-            mark = mark_class.objects.get(**params)
-
-            if task.overwrite:
-                overwrite_mark(entity, entity_class, mark,
-                               mark_class, tag_class, data, sheet)
-            else:
-                task.success_items += 1
-                task.finished_items += 1
-                task.save(update_fields=['success_items', 'finished_items'])
-                continue
-
-        except ObjectDoesNotExist:
-            add_new_mark(data, task.user, entity, entity_class,
-                         mark_class, tag_class, sheet, task.default_public)
-
-        except Exception as e:
-            logger.error(
-                "Unknown exception when syncing marks", exc_info=e)
-            task.failed_urls.append(data.url)
-            task.finished_items += 1
-            task.save(update_fields=['failed_urls', 'finished_items'])
-            continue
-
-        task.success_items += 1
-        task.finished_items += 1
-        task.save(update_fields=['success_items', 'finished_items'])
+                entity_class.__name__.lower(): entity,
+            }).first()
 
-    # if task finish
-    if len(items) == 0:
-        task.is_finished = True
-        task.clear_breakpoint()
-        task.save(update_fields=['is_finished', 'break_point'])
+    if mark is None or task.overwrite:
+        writer.add(item, entity, mark)
+    return True
 
 
 def translate_status(sheet_name):
@@ -388,11 +740,4 @@ def translate_status(sheet_name):
     raise ValueError("Not valid status")
 
 
-sync_task_manager = SyncTaskManger()
-
-# sync_task_manager.start()
-
-signal.signal(signal.SIGTERM, sync_task_manager.stop)
-if sys.platform.startswith('linux'):
-    signal.signal(signal.SIGHUP, sync_task_manager.stop)
-signal.signal(signal.SIGINT, sync_task_manager.stop)
+sync_task_manager = SyncTaskManager()
@@ -58,6 +58,15 @@ class SyncTask(models.Model):
 
     break_point = models.CharField(max_length=100, default="", blank=True)
 
+    #-----------------------------------#
+    # scheduling
+    #-----------------------------------#
+    # worker running the task, and until when
+    lease_owner = models.CharField(max_length=100, default="", blank=True)
+    leased_until = models.DateTimeField(null=True, blank=True)
+    # tasks that ran least recently are picked first
+    last_run_time = models.DateTimeField(null=True, blank=True)
+
     started_time = models.DateTimeField(auto_now_add=True)
     ended_time = models.DateTimeField(auto_now=True)
 
@@ -1,3 +1,54 @@
+from datetime import timedelta
 from django.test import TestCase
+from django.utils import timezone
+from users.models import User
+from .jobs import ProgressCheckpoint
+from .models import SyncTask
 
-# Create your tests here.
+
+class ProgressCheckpointTest(TestCase):
+
+    def setUp(self):
+        user = User.objects.create(
+            username='test', mastodon_id=1, mastodon_site='example.org')
+        self.task = SyncTask.objects.create(
+            user=user,
+            sync_book=True,
+            sync_movie=True,
+            sync_music=True,
+            sync_game=True,
+            default_public=True,
+            lease_owner='host:1:0',
+            leased_until=timezone.now() + timedelta(minutes=5),
+        )
+        self.progress = ProgressCheckpoint(SyncTask.objects.get(pk=self.task.pk))
+
+    def handle_row(self, row_index):
+        self.progress.handle_row(
+            '想看', row_index, f'https://book.douban.com/subject/{row_index}/', True)
+
+    def test_progress_is_saved_while_leased(self):
+        self.handle_row(1)
+        self.assertTrue(self.progress.flush())
+        self.task.refresh_from_db()
+        self.assertEqual(self.task.get_breakpoint(), ('想看', 2))
+        self.assertEqual(self.task.finished_items, 1)
+
+    def test_progress_is_dropped_after_taken_over(self):
+        self.handle_row(1)
+        self.progress.flush()
+        SyncTask.objects.filter(pk=self.task.pk).update(lease_owner='host:2:0')
+
+        self.handle_row(2)
+        self.assertFalse(self.progress.flush())
+        self.task.refresh_from_db()
+        self.assertEqual(self.task.get_breakpoint(), ('想看', 2))
+        self.assertEqual(self.task.finished_items, 1)
+
+    def test_progress_is_dropped_after_lease_expired(self):
+        SyncTask.objects.filter(pk=self.task.pk).update(
+            leased_until=timezone.now() - timedelta(seconds=1))
+        self.handle_row(1)
+        self.assertFalse(self.progress.flush())
+        self.task.refresh_from_db()
+        self.assertEqual(self.task.break_point, '')
@@ -1,3 +1,221 @@
+from datetime import timedelta
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from common.models import MarkStatusEnum, UserMarkStats
+from books.models import Book, BookMark
+from movies.models import Movie, MovieMark
+from games.models import Game, GameMark
+from music.models import Album, AlbumMark, Song, SongMark
+from .models import User
+from .views import count_marks, filter_marks
 
-# Create your tests here.
+
+class MarksTestCase(TestCase):
+    """
+    Logged in as a user with a mastodon token, who can be given marks.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(
+            username='test', mastodon_id=1, mastodon_site='example.org')
+        self.client.force_login(self.user)
+        session = self.client.session
+        session['oauth_token'] = 'token'
+        session.save()
+
+    def create_marks(self, entity_class, mark_class, number, status=MarkStatusEnum.COLLECT):
+        """
+        Create public marks of new entities, the later created the more recently edited.
+        """
+        name = entity_class.__name__.lower()
+        start = entity_class.objects.count()
+        marks = []
+        for i in range(start, start + number):
+            entity = entity_class.objects.create(
+                title=f'{name} {i}',
+                source_url=f'https://example.org/{name}/{i}/',
+                source_site='douban',
+            )
+            marks.append(mark_class.objects.create(**{
+                'owner': self.user,
+                name: entity,
+                'status': status,
+                'is_private': False,
+                'edited_time': timezone.now() + timedelta(minutes=len(marks)),
+            }))
+        return marks
+
+
+class MarkListQueriesTest(MarksTestCase):
+    """
+    Marks of a list page should be fetched with their entities,
+    in a constant number of queries regardless of the page size.
+    """
+
+    def setUp(self):
+        super().setUp()
+        marks = self.create_marks(Book, BookMark, 10)
+        BookMark.objects.filter(pk__in=[mark.pk for mark in marks[::2]]).update(is_private=True)
+
+    def test_get_available_by_user(self):
+        for page_size in (1, 5, 10):
+            with self.assertNumQueries(1):
+                marks = BookMark.get_available_by_user(self.user, True)[:page_size]
+                titles = [mark.book.title for mark in marks]
+            self.assertEqual(len(titles), page_size)
+
+        with self.assertNumQueries(1):
+            marks = BookMark.get_available_by_user(self.user, False)
+            titles = [mark.book.title for mark in marks]
+        self.assertEqual(len(titles), 5)
+
+
+class MarkListViewQueriesTest(MarksTestCase):
+    """
+    Own mark list pages should make the same queries for a page of one mark
+    and for a full page.
+    """
+
+    def assertConstantQueries(self, url, add_marks):
+        add_marks(1)
+        UserMarkStats.rebuild()
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['marks']), 1)
+
+        add_marks(30)
+        UserMarkStats.rebuild()
+        with self.assertNumQueries(len(context.captured_queries)):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['marks']), response.context['marks'].paginator.per_page)
+
+    def test_book_list(self):
+        self.assertConstantQueries(
+            reverse('users:book_list', args=[self.user.id, 'collect']),
+            lambda number: self.create_marks(Book, BookMark, number))
+
+    def test_movie_list(self):
+        self.assertConstantQueries(
+            reverse('users:movie_list', args=[self.user.id, 'collect']),
+            lambda number: self.create_marks(Movie, MovieMark, number))
+
+    def test_game_list(self):
+        self.assertConstantQueries(
+            reverse('users:game_list', args=[self.user.id, 'collect']),
+            lambda number: self.create_marks(Game, GameMark, number))
+
+    def test_music_list(self):
+        def add_marks(number):
+            self.create_marks(Album, AlbumMark, number)
+            self.create_marks(Song, SongMark, number)
+
+        self.assertConstantQueries(
+            reverse('users:music_list', args=[self.user.id, 'collect']), add_marks)
+
+
+class MarkStatsDriftTest(MarksTestCase):
+    """
+    List pages should correct mark stats drifted from marks,
+    e.g. after marks are deleted without updating stats.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.url = reverse('users:book_list', args=[self.user.id, 'collect'])
+
+    def get_stats_count(self):
+        return UserMarkStats.get_counts(self.user, True)[('book', MarkStatusEnum.COLLECT)]
+
+    def test_fewer_marks_than_counted(self):
+        marks = self.create_marks(Book, BookMark, 25)
+        UserMarkStats.rebuild()
+        BookMark.objects.filter(pk__in=[mark.pk for mark in marks[:10]]).delete()
+
+        # the second page is gone, the last page is shown instead
+        marks = self.client.get(self.url, {'page': 2}).context['marks']
+        self.assertEqual(marks.number, 1)
+        self.assertEqual(len(marks), 15)
+        self.assertEqual(marks.paginator.count, 15)
+        self.assertEqual(self.get_stats_count(), 15)
+
+    def test_more_marks_than_counted(self):
+        self.create_marks(Book, BookMark, 5)
+        UserMarkStats.rebuild()
+        self.create_marks(Book, BookMark, 20)
+
+        marks = self.client.get(self.url).context['marks']
+        self.assertEqual(len(marks), 20)
+        self.assertEqual(marks.paginator.num_pages, 2)
+        self.assertEqual(self.get_stats_count(), 25)
+
+    def test_counted_marks_are_not_recounted(self):
+        self.create_marks(Book, BookMark, 25)
+        UserMarkStats.rebuild()
+        stats_ids = list(UserMarkStats.objects.values_list('pk', flat=True))
+        for page in (1, 2):
+            self.client.get(self.url, {'page': page})
+        # reconciling recreates stats
+        self.assertEqual(list(UserMarkStats.objects.values_list('pk', flat=True)), stats_ids)
+
+
+class MusicListTest(MarksTestCase):
+
+    def test_album_and_song_marks_are_paginated_together(self):
+        # edited time of album and song marks are interleaved
+        album_marks = self.create_marks(Album, AlbumMark, 15)
+        song_marks = self.create_marks(Song, SongMark, 15)
+        UserMarkStats.rebuild()
+        expected = sorted(album_marks + song_marks, key=lambda e: e.edited_time, reverse=True)
+
+        url = reverse('users:music_list', args=[self.user.id, 'collect'])
+        first_page = self.client.get(url).context['marks']
+        second_page = self.client.get(url, {'page': 2}).context['marks']
+        self.assertEqual(first_page.paginator.count, 30)
+        self.assertEqual(
+            [(mark.type, mark.pk) for mark in list(first_page) + list(second_page)],
+            [(mark.get_category_name(), mark.pk) for mark in expected]
+        )
+        for mark in first_page:
+            self.assertEqual(mark.music, getattr(mark, mark.type))
+
+
+class HomeMarksTest(MarksTestCase):
+
+    def test_count_and_filter_marks(self):
+        wish_marks = self.create_marks(Book, BookMark, 7, MarkStatusEnum.WISH)
+        self.create_marks(Book, BookMark, 2, MarkStatusEnum.DO)
+        album_marks = self.create_marks(Album, AlbumMark, 3, MarkStatusEnum.COLLECT)
+        song_marks = self.create_marks(Song, SongMark, 4, MarkStatusEnum.COLLECT)
+        private_mark = wish_marks[0]
+        private_mark.is_private = True
+        private_mark.save()
+        UserMarkStats.rebuild()
+
+        marks_count = count_marks(self.user, True)
+        self.assertEqual(marks_count['wish_book_count'], 7)
+        self.assertEqual(marks_count['do_book_count'], 2)
+        self.assertEqual(marks_count['collect_book_count'], 0)
+        self.assertEqual(marks_count['collect_music_count'], 7)
+        self.assertEqual(count_marks(self.user, False)['wish_book_count'], 6)
+
+        books = filter_marks(self.user.user_bookmarks.all(), 5, 'book', marks_count)
+        self.assertEqual(books['wish_book_marks'], wish_marks[::-1][:5])
+        self.assertTrue(books['wish_book_more'])
+        self.assertEqual(len(books['do_book_marks']), 2)
+        self.assertFalse(books['do_book_more'])
+        self.assertEqual(books['collect_book_marks'], [])
+
+        music = filter_marks(
+            [self.user.user_songmarks.all(), self.user.user_albummarks.all()], 5, 'music', marks_count)
+        expected = sorted(album_marks + song_marks, key=lambda e: e.edited_time, reverse=True)[:5]
+        self.assertEqual(
+            [(mark.type, mark.pk) for mark in music['collect_music_marks']],
+            [(mark.get_category_name(), mark.pk) for mark in expected]
+        )
+        self.assertTrue(music['collect_music_more'])
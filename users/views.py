@@ -3,18 +3,17 @@ from django.http import HttpResponseBadRequest, HttpResponse
 from django.contrib.auth.decorators import login_required
 from django.contrib import auth
 from django.contrib.auth import authenticate
-from django.core.paginator import Paginator
 from django.utils.translation import gettext_lazy as _
 from django.core.exceptions import ObjectDoesNotExist
-from django.db.models import Count
+from django.db.models import Value, CharField, prefetch_related_objects
 from .models import User, Report, Preference
 from .forms import ReportForm
 from mastodon.auth import *
 from mastodon.api import *
 from mastodon import mastodon_request_included
 from common.config import *
-from common.models import MarkStatusEnum
-from common.utils import PageLinksGenerator
+from common.models import MarkStatusEnum, Entity, UserMarkStats
+from common.utils import PageLinksGenerator, CountedPaginator
 from management.models import Announcement
 from books.models import *
 from movies.models import *
@@ -27,6 +26,15 @@ from games.forms import GameMarkStatusTranslator
 from mastodon.models import MastodonApplication
 
 
+# mark categories counted by each type of mark lists
+MARK_COUNT_CATEGORIES = {
+    'book': ['book'],
+    'movie': ['movie'],
+    'game': ['game'],
+    'music': ['album', 'song'],
+}
+
+
 # Views
 ########################################
 
@@ -178,10 +186,11 @@ def home(request, id):
 
         # access one's own home page
         if user == request.user:
+            include_private = True
             reports = Report.objects.order_by(
                 '-submitted_time').filter(is_read=False)
             unread_announcements = Announcement.objects.filter(
-                    pk__gt=request.user.read_announcement_index).order_by('-pk')
+                    pk__gt=request.user.read_announcement_index).defer('content', 'content_html').order_by('-pk')
             try:
                 request.user.read_announcement_index = Announcement.objects.latest(
                     'pk').pk
@@ -224,34 +233,24 @@ def home(request, id):
             song_marks = SongMark.get_available_by_user(user, relation['following'])
             album_marks = AlbumMark.get_available_by_user(user, relation['following'])
             game_marks = GameMark.get_available_by_user(user, relation['following'])
+            include_private = relation['following']
+
 
+        # counts of all categories are read from denormalized stats
+        marks_count = count_marks(user, include_private)
 
         # book marks
-        filtered_book_marks = filter_marks(book_marks, BOOKS_PER_SET, 'book')          
-        book_marks_count = count_marks(book_marks, "book")
+        filtered_book_marks = filter_marks(book_marks, BOOKS_PER_SET, 'book', marks_count)
 
         # movie marks
-        filtered_movie_marks = filter_marks(movie_marks, MOVIES_PER_SET, 'movie')
-        movie_marks_count= count_marks(movie_marks, "movie")
+        filtered_movie_marks = filter_marks(movie_marks, MOVIES_PER_SET, 'movie', marks_count)
 
         # game marks
-        filtered_game_marks = filter_marks(game_marks, GAMES_PER_SET, 'game')
-        game_marks_count = count_marks(game_marks, "game")
+        filtered_game_marks = filter_marks(game_marks, GAMES_PER_SET, 'game', marks_count)
 
         # music marks
-        filtered_music_marks = filter_marks([song_marks, album_marks], MUSIC_PER_SET, 'music')
-        music_marks_count = count_marks([song_marks, album_marks], "music")
-     
-
-        for mark in filtered_music_marks["do_music_marks"] +\
-            filtered_music_marks["wish_music_marks"] +\
-                filtered_music_marks["collect_music_marks"]:
-            # for template convenience
-            if mark.__class__ == AlbumMark:
-                mark.type = "album"
-            else:
-                mark.type = "song"
-        
+        filtered_music_marks = filter_marks([song_marks, album_marks], MUSIC_PER_SET, 'music', marks_count)
+
         try:
             layout = user.preference.get_serialized_home_layout()
         except ObjectDoesNotExist:
@@ -267,10 +266,7 @@ def home(request, id):
                 **filtered_movie_marks,
                 **filtered_game_marks,
                 **filtered_music_marks,
-                **book_marks_count,
-                **movie_marks_count,
-                **music_marks_count,
-                **game_marks_count,
+                **marks_count,
                 'layout': layout,
                 'reports': reports,
                 'unread_announcements': unread_announcements,
@@ -281,47 +277,91 @@ def home(request, id):
         return HttpResponseBadRequest()
 
 
-def filter_marks(querysets, maximum, type_name):
+def filter_marks(querysets, maximum, type_name, marks_count):
     """
     Filter marks by amount limits and order them edited time, store results in a dict, 
     which could be directly used in template.
+    The latest marks of all statuses are fetched in one query as a union of slices,
+    multiple querysets are combined as rows and then fetched by `fetch_mark_rows`.
     @param querysets: one queryset or multiple querysets as a list
+    @param marks_count: the result of `count_marks`, tells if there are more marks
     """
     result = {}
+    marks_by_status = {status: [] for status in MarkStatusEnum.values}
     if not isinstance(querysets, list):
-        querysets = [querysets]
-
-    for status in MarkStatusEnum.values:
-        marks = []
-        count = 0
-        for queryset in querysets:
-            marks += list(queryset.filter(status=MarkStatusEnum[status.upper()]).order_by("-edited_time")[:maximum])
-            count += queryset.filter(status=MarkStatusEnum[status.upper()]).count()
-            
+        # joins are not kept by union, entities are prefetched instead
+        slices = [
+            querysets.select_related(None).filter(status=status).order_by("-edited_time")[:maximum]
+            for status in MarkStatusEnum.values
+        ]
+        marks = list(slices[0].union(*slices[1:], all=True))
+        prefetch_related_objects(marks, querysets.model.get_entity_field_name())
+        for mark in marks:
+            marks_by_status[mark.status].append(mark)
+    else:
+        slices = [
+            annotate_mark_rows(queryset).filter(status=status).order_by("-edited_time")[:maximum]
+            for queryset in querysets for status in MarkStatusEnum.values
+        ]
+        rows_by_status = {status: [] for status in MarkStatusEnum.values}
+        for row in slices[0].union(*slices[1:], all=True):
+            rows_by_status[row['status']].append(row)
+        for status, rows in rows_by_status.items():
+            rows = sorted(rows, key=lambda e: e['edited_time'], reverse=True)[:maximum]
+            marks_by_status[status] = fetch_mark_rows(rows, querysets)
+
+    for status, marks in marks_by_status.items():
         # marks
         marks = sorted(marks, key=lambda e: e.edited_time, reverse=True)[:maximum]
         result[f"{status}_{type_name}_marks"] = marks
         # flag indicates if marks are more than `maximun`
-        if count > maximum:
+        if marks_count[f"{status}_{type_name}_count"] > maximum:
             result[f"{status}_{type_name}_more"] = True
         else:
             result[f"{status}_{type_name}_more"] = False
 
     return result
 
-def count_marks(querysets, type_name):
+def annotate_mark_rows(queryset):
     """
-    Count all available marks, then assembly a dict to be used in template
-    @param querysets: one queryset or multiple querysets as a list
+    Reduce the queryset into rows of (id, edited_time, status, category),
+    thus querysets of different mark classes can be combined with UNION.
     """
+    return queryset.annotate(
+        category=Value(queryset.model.get_category_name(), output_field=CharField()),
+    ).values('id', 'edited_time', 'status', 'category')
+
+def fetch_mark_rows(rows, querysets):
+    """
+    Fetch marks of given rows with their entities, keeping the order of rows.
+    The category of each mark is set as `type` for template convenience.
+    @param querysets: querysets of marks the rows come from
+    """
+    queryset_mapping = {queryset.model.get_category_name(): queryset for queryset in querysets}
+    ids = {}
+    for row in rows:
+        ids.setdefault(row['category'], []).append(row['id'])
+    marks = {}
+    for category, id_list in ids.items():
+        # the foreign key field that points to entity
+        # is named as the lower case name of that entity
+        queryset = queryset_mapping[category].select_related(category)
+        for pk, mark in queryset.in_bulk(id_list).items():
+            mark.type = category
+            marks[(category, pk)] = mark
+    return [marks[(row['category'], row['id'])] for row in rows if (row['category'], row['id']) in marks]
+
+def count_marks(user, include_private):
+    """
+    Count all available marks by the denormalized stats, then assembly a dict to be used in template
+    @param include_private: if private marks are available to current user
+    """
+    counts = UserMarkStats.get_counts(user, include_private)
     result = {}
-    if not isinstance(querysets, list):
-        querysets = [querysets]
-    for status in MarkStatusEnum.values:
-        count = 0
-        for queryset in querysets:
-            count += queryset.filter(status=MarkStatusEnum[status.upper()]).count()
-        result[f"{status}_{type_name}_count"] = count
+    for type_name, categories in MARK_COUNT_CATEGORIES.items():
+        for status in MarkStatusEnum.values:
+            result[f"{status}_{type_name}_count"] = sum(
+                counts.get((category, status), 0) for category in categories)
     return result
 
 
@@ -470,19 +510,22 @@ def book_list(request, id, status):
                         'msg': msg,
                     }
                 )
+            include_private = relation['following']
             queryset = BookMark.get_available_by_user(user, relation['following']).filter(
                 status=MarkStatusEnum[status.upper()]).order_by("-edited_time")
             user.target_site_id = get_cross_site_id(
                 user, request.user.mastodon_site, request.session['oauth_token'])
         else:
+            include_private = True
             queryset = BookMark.objects.filter(
-                owner=user, status=MarkStatusEnum[status.upper()]).order_by("-edited_time")
-        paginator = Paginator(queryset, ITEMS_PER_PAGE)
+                owner=user, status=MarkStatusEnum[status.upper()]).select_related('book').order_by("-edited_time")
+        marks_count = count_marks(user, include_private)[f"{MarkStatusEnum[status.upper()].value}_book_count"]
+        paginator = CountedPaginator(
+            queryset, ITEMS_PER_PAGE, marks_count,
+            lambda: UserMarkStats.reconcile(user, [BookMark], MarkStatusEnum[status.upper()]))
         page_number = request.GET.get('page', default=1)
         marks = paginator.get_page(page_number)
-        for mark in marks:
-            mark.book.tag_list = mark.book.get_tags_manager().values('content').annotate(
-                tag_frequency=Count('content')).order_by('-tag_frequency')[:TAG_NUMBER_ON_LIST]
+        Entity.set_tag_lists([mark.book for mark in marks], TAG_NUMBER_ON_LIST)
         marks.pagination = PageLinksGenerator(PAGE_LINK_NUMBER, page_number, paginator.num_pages)
         list_title = str(BookMarkStatusTranslator(MarkStatusEnum[status.upper()])) + str(_("的书"))
         return render(
@@ -542,17 +585,20 @@ def movie_list(request, id, status):
             user.target_site_id = get_cross_site_id(
                 user, request.user.mastodon_site, request.session['oauth_token'])
         
+            include_private = relation['following']
             queryset = MovieMark.get_available_by_user(user, relation['following']).filter(
                 status=MarkStatusEnum[status.upper()]).order_by("-edited_time")
         else:
+            include_private = True
             queryset = MovieMark.objects.filter(
-                owner=user, status=MarkStatusEnum[status.upper()]).order_by("-edited_time")
-        paginator = Paginator(queryset, ITEMS_PER_PAGE)
+                owner=user, status=MarkStatusEnum[status.upper()]).select_related('movie').order_by("-edited_time")
+        marks_count = count_marks(user, include_private)[f"{MarkStatusEnum[status.upper()].value}_movie_count"]
+        paginator = CountedPaginator(
+            queryset, ITEMS_PER_PAGE, marks_count,
+            lambda: UserMarkStats.reconcile(user, [MovieMark], MarkStatusEnum[status.upper()]))
         page_number = request.GET.get('page', default=1)
         marks = paginator.get_page(page_number)
-        for mark in marks:
-            mark.movie.tag_list = mark.movie.get_tags_manager().values('content').annotate(
-                tag_frequency=Count('content')).order_by('-tag_frequency')[:TAG_NUMBER_ON_LIST]
+        Entity.set_tag_lists([mark.movie for mark in marks], TAG_NUMBER_ON_LIST)
         marks.pagination = PageLinksGenerator(PAGE_LINK_NUMBER, page_number, paginator.num_pages)
         list_title = str(MovieMarkStatusTranslator(MarkStatusEnum[status.upper()])) + str(_("的电影和剧集"))
         return render(
@@ -612,17 +658,20 @@ def game_list(request, id, status):
             user.target_site_id = get_cross_site_id(
                 user, request.user.mastodon_site, request.session['oauth_token'])
         
+            include_private = relation['following']
             queryset = GameMark.get_available_by_user(user, relation['following']).filter(
                 status=MarkStatusEnum[status.upper()]).order_by("-edited_time")
         else:
+            include_private = True
             queryset = GameMark.objects.filter(
-                owner=user, status=MarkStatusEnum[status.upper()]).order_by("-edited_time")
-        paginator = Paginator(queryset, ITEMS_PER_PAGE)
+                owner=user, status=MarkStatusEnum[status.upper()]).select_related('game').order_by("-edited_time")
+        marks_count = count_marks(user, include_private)[f"{MarkStatusEnum[status.upper()].value}_game_count"]
+        paginator = CountedPaginator(
+            queryset, ITEMS_PER_PAGE, marks_count,
+            lambda: UserMarkStats.reconcile(user, [GameMark], MarkStatusEnum[status.upper()]))
         page_number = request.GET.get('page', default=1)
         marks = paginator.get_page(page_number)
-        for mark in marks:
-            mark.game.tag_list = mark.game.get_tags_manager().values('content').annotate(
-                tag_frequency=Count('content')).order_by('-tag_frequency')[:TAG_NUMBER_ON_LIST]
+        Entity.set_tag_lists([mark.game for mark in marks], TAG_NUMBER_ON_LIST)
         marks.pagination = PageLinksGenerator(PAGE_LINK_NUMBER, page_number, paginator.num_pages)
         list_title = str(GameMarkStatusTranslator(MarkStatusEnum[status.upper()])) + str(_("的游戏"))
         return render(
@@ -679,29 +728,36 @@ def music_list(request, id, status):
                         'msg': msg,
                     }
                 )
-            queryset = list(AlbumMark.get_available_by_user(user, relation['following']).filter(
-                status=MarkStatusEnum[status.upper()])) \
-                + list(SongMark.get_available_by_user(user, relation['following']).filter(
-                    status=MarkStatusEnum[status.upper()]))
+            include_private = relation['following']
+            querysets = [
+                AlbumMark.get_available_by_user(user, relation['following']).filter(
+                    status=MarkStatusEnum[status.upper()]),
+                SongMark.get_available_by_user(user, relation['following']).filter(
+                    status=MarkStatusEnum[status.upper()]),
+            ]
             
             user.target_site_id = get_cross_site_id(
                 user, request.user.mastodon_site, request.session['oauth_token'])
         else:
-            queryset = list(AlbumMark.objects.filter(owner=user, status=MarkStatusEnum[status.upper()])) \
-                + list(SongMark.objects.filter(owner=user, status=MarkStatusEnum[status.upper()]))
-        queryset = sorted(queryset, key=lambda e: e.edited_time, reverse=True)
-        paginator = Paginator(queryset, ITEMS_PER_PAGE)
+            include_private = True
+            querysets = [
+                AlbumMark.objects.filter(owner=user, status=MarkStatusEnum[status.upper()]),
+                SongMark.objects.filter(owner=user, status=MarkStatusEnum[status.upper()]),
+            ]
+        # album and song marks are combined and paginated by the database,
+        # only the marks of current page are fetched
+        queryset = annotate_mark_rows(querysets[0]).union(
+            annotate_mark_rows(querysets[1]), all=True).order_by('-edited_time', 'category', 'id')
+        marks_count = count_marks(user, include_private)[f"{MarkStatusEnum[status.upper()].value}_music_count"]
+        paginator = CountedPaginator(
+            queryset, ITEMS_PER_PAGE, marks_count,
+            lambda: UserMarkStats.reconcile(user, [AlbumMark, SongMark], MarkStatusEnum[status.upper()]))
         page_number = request.GET.get('page', default=1)
         marks = paginator.get_page(page_number)
+        marks.object_list = fetch_mark_rows(marks.object_list, querysets)
         for mark in marks:
-            if mark.__class__ == AlbumMark:
-                mark.music = mark.album
-                mark.music.tag_list = mark.album.get_tags_manager().values('content').annotate(
-                    tag_frequency=Count('content')).order_by('-tag_frequency')[:TAG_NUMBER_ON_LIST]
-            elif mark.__class__ == SongMark:
-                mark.music = mark.song
-                mark.music.tag_list = mark.song.get_tags_manager().values('content').annotate(
-                    tag_frequency=Count('content')).order_by('-tag_frequency')[:TAG_NUMBER_ON_LIST]
+            mark.music = getattr(mark, mark.type)
+        Entity.set_tag_lists([mark.music for mark in marks], TAG_NUMBER_ON_LIST)
 
         marks.pagination = PageLinksGenerator(PAGE_LINK_NUMBER, page_number, paginator.num_pages)
         list_title = str(MusicMarkStatusTranslator(MarkStatusEnum[status.upper()])) + str(_("的音乐"))
@@ -786,11 +842,13 @@ def manage_report(request):
 ########################################
 def auth_login(request, user, token):
     """ Decorates django ``login()``. Attach token to session."""
+    clear_relationships_cache(token)
     request.session['oauth_token'] = token
     auth.login(request, user)
 
 
 def auth_logout(request):
     """ Decorates django ``logout()``. Release token in session."""
+    clear_relationships_cache(request.session['oauth_token'])
     del request.session['oauth_token']
     auth.logout(request)    